@@ -74,11 +74,15 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'batch_processing.middleware.ProfilingMiddleware',
     'django.middleware.security.SecurityMiddleware',
+    'batch_processing.middleware.ResponseCompressionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
     'django.contrib.auth.middleware.AuthenticationMiddleware',
+    'batch_processing.middleware.AdmissionControlMiddleware',
+    'batch_processing.middleware.RequestDecompressionMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
 ]
@@ -112,12 +116,40 @@ DATABASES = {
         'ENGINE': 'django.db.backends.postgresql',
         'NAME': db_config.path[1:],
         'HOST': db_config.hostname,
-        'POST': db_config.port,
+        'PORT': db_config.port,
         'USER': db_config.username,
         'PASSWORD': db_config.password
     }
 }
 
+# Read replicas, as a comma-separated list of URIs.  Retrieval views read from these; see
+# batch_processing.db_routing.  For local testing, point a replica URI at a second database
+# (or at the primary itself).  Under test, replicas mirror the default database.
+DATABASE_REPLICAS = []
+for replica_number, replica_uri in enumerate(
+        uri for uri in os.getenv('DATABASE_REPLICA_URIS', '').split(',') if uri.strip()):
+    replica_config = urlparse(replica_uri.strip())
+    replica_alias = f'replica_{replica_number}'
+    DATABASES[replica_alias] = {
+        'ENGINE': 'django.db.backends.postgresql',
+        'NAME': replica_config.path[1:],
+        'HOST': replica_config.hostname,
+        'PORT': replica_config.port,
+        'USER': replica_config.username,
+        'PASSWORD': replica_config.password,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(replica_alias)
+DATABASE_ROUTERS = ['batch_processing.db_routing.ReplicaRouter']
+# 'round_robin' or 'least_latency'
+DATABASE_REPLICA_STRATEGY = os.getenv('DATABASE_REPLICA_STRATEGY', 'round_robin')
+# least_latency forgets a replica's figure after this long, so a slow replica that has recovered
+# gets tried again
+DATABASE_REPLICA_LATENCY_MAX_AGE_SECONDS = float(
+    os.getenv('DATABASE_REPLICA_LATENCY_MAX_AGE_SECONDS', 30))
+# After a client writes, its reads stay on the primary for this long
+DATABASE_READ_YOUR_WRITES_SECONDS = int(os.getenv('DATABASE_READ_YOUR_WRITES_SECONDS', 10))
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.2/ref/settings/#auth-password-validators
@@ -165,6 +197,83 @@ MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 
 DEFAULT_AUTO_FIELD = 'django.db.models.BigAutoField'
 
+# Batch deletion (DELETE batch/batch/<id>/ and the prune_batches command) works in chunks of
+# this many objects, each deleted with its data items, sleeping between chunks to keep lock
+# time and replication lag down.
+BATCH_DELETE_CHUNK_SIZE = int(os.getenv('BATCH_DELETE_CHUNK_SIZE', 1000))
+BATCH_DELETE_THROTTLE_SECONDS = float(os.getenv('BATCH_DELETE_THROTTLE_SECONDS', 0.1))
+# The DELETE route stops after this many seconds, well inside proxy and worker timeouts, and
+# answers 202 with what it managed; the client repeats the request to carry on.
+BATCH_DELETE_REQUEST_SECONDS = float(os.getenv('BATCH_DELETE_REQUEST_SECONDS', 20))
+
+# In-memory inverted index for exact key/value object_list queries (batch_processing.object_index).
+# Off by default; every worker process holds its own copy of the data.
+OBJECT_INDEX_ENABLED = os.getenv('OBJECT_INDEX_ENABLED', '') == '1'
+# How often to replay the change log, and how far behind it may get before we fall back to SQL
+OBJECT_INDEX_SYNC_SECONDS = float(os.getenv('OBJECT_INDEX_SYNC_SECONDS', 1.0))
+OBJECT_INDEX_MAX_LAG = int(os.getenv('OBJECT_INDEX_MAX_LAG', 10000))
+
+# Cache-Control header for each retrieval route, by URL name.  Responses carry ETags, so
+# 'no-cache' (always revalidate with If-None-Match) is cheap for clients and for us.
+CACHE_CONTROL = {
+    'object': 'private, no-cache',
+    'object_list': 'private, no-cache',
+}
+
+# object_list value__startswith / value__contains searches: the most data items a search may
+# match, how long its query may run, and the shortest substring we will search for.
+OBJECT_LIST_SEARCH_LIMIT = int(os.getenv('OBJECT_LIST_SEARCH_LIMIT', 1000))
+OBJECT_LIST_SEARCH_TIMEOUT_MS = int(os.getenv('OBJECT_LIST_SEARCH_TIMEOUT_MS', 2000))
+OBJECT_LIST_CONTAINS_MIN_LENGTH = 3
+
+# Compressed bodies (Content-Encoding: gzip, or zstd with the zstandard package installed) are
+# accepted on these routes, by URL name, up to this size once decompressed.
+REQUEST_DECOMPRESSION_URL_NAMES = ('body', 'file')
+REQUEST_DECOMPRESSED_MAX_SIZE = int(os.getenv('REQUEST_DECOMPRESSED_MAX_SIZE', 64 * 1024 * 1024))
+# Responses from these routes are compressed when the client accepts it and they are at
+# least this many bytes.
+RESPONSE_COMPRESSION_URL_NAMES = ('object', 'object_list', 'changes')
+RESPONSE_COMPRESSION_MIN_SIZE = 1024
+
+# Reverse proxies in front of the app that append the client address to X-Forwarded-For.
+# Clients are told apart by that address (batch_processing.clients), for admission limits and
+# read-your-writes pins.  Leave at 0 when clients connect directly, or X-Forwarded-For is
+# whatever they say it is.
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 0))
+
+# Admission control for uploads (batch_processing.admission), per worker process.
+ADMISSION_URL_NAMES = ('body', 'file')
+# Largest upload accepted, in bytes on the wire (Content-Length); anything bigger is a 413.
+# Kept in line with REQUEST_DECOMPRESSED_MAX_SIZE, since an uncompressed upload is its own
+# decompressed size.  Burst sizes below only slow large uploads down; they never refuse them.
+ADMISSION_MAX_UPLOAD_BYTES = int(
+    os.getenv('ADMISSION_MAX_UPLOAD_BYTES', REQUEST_DECOMPRESSED_MAX_SIZE))
+# Concurrent uploads, in slots; an upload takes one slot per ADMISSION_BYTES_PER_SLOT bytes
+ADMISSION_MAX_CONCURRENT = int(os.getenv('ADMISSION_MAX_CONCURRENT', 8))
+ADMISSION_BYTES_PER_SLOT = 4 * 1024 * 1024
+ADMISSION_MAX_CONCURRENT_PER_CLIENT = int(os.getenv('ADMISSION_MAX_CONCURRENT_PER_CLIENT', 2))
+# Uploads waiting for slots, and how long each may wait
+ADMISSION_QUEUE_SIZE = int(os.getenv('ADMISSION_QUEUE_SIZE', 16))
+ADMISSION_QUEUE_TIMEOUT_SECONDS = 10
+# Token buckets on payload bytes, overall and per client.  A rate of 0 turns a bucket off.
+ADMISSION_BYTES_PER_SECOND = int(os.getenv('ADMISSION_BYTES_PER_SECOND', 20 * 1024 * 1024))
+ADMISSION_BURST_BYTES = 64 * 1024 * 1024
+ADMISSION_CLIENT_BYTES_PER_SECOND = int(
+    os.getenv('ADMISSION_CLIENT_BYTES_PER_SECOND', 5 * 1024 * 1024))
+ADMISSION_CLIENT_BURST_BYTES = 32 * 1024 * 1024
+
+# Request profiling (batch_processing.profiling).  A request is profiled if it sends the
+# X-Profile header with this token (empty turns that off), or if it is sampled at this rate.
+PROFILING_TOKEN = os.getenv('PROFILING_TOKEN', '')
+PROFILING_HEADER = 'HTTP_X_PROFILE'
+PROFILING_SAMPLE_RATE = float(os.getenv('PROFILING_SAMPLE_RATE', 0))
+PROFILING_DIR = os.getenv('PROFILING_DIR', os.path.join(BASE_DIR, 'profiles'))
+PROFILING_MAX_REPORTS = 100
+
+# Change feed (batch/changes/) page size: the default, and the most a client may ask for
+CHANGE_FEED_PAGE_SIZE = 500
+CHANGE_FEED_MAX_PAGE_SIZE = 5000
+
 # REST_FRAMEWORK = {
 #     "DEFAULT_AUTHENTICATION_CLASSES": [
 #         "rest_framework.authentication.BasicAuthentication",
@@ -0,0 +1,251 @@
+"""
+Admission control for the ingest routes.
+
+A handful of clients uploading huge batches at once can take every database connection and
+starve the retrieval routes.  Before an upload is read at all, we check, using its
+Content-Length:
+
+ - payload size, against settings.ADMISSION_MAX_UPLOAD_BYTES (413 if larger);
+ - payload byte rate, with token buckets per client and overall.  Over the client's rate is a
+   429, over the overall rate a 503, each with a Retry-After saying when the bytes will be
+   available.  Tokens are only taken once the upload is admitted.  An upload bigger than a
+   bucket's burst size goes ahead once the bucket is full and leaves it in debt, so it is
+   slowed down, not refused;
+ - concurrent uploads per client (429 once exceeded);
+ - overall concurrency, in slots.  An upload takes one slot per
+   settings.ADMISSION_BYTES_PER_SLOT of payload, so one huge upload counts for several small
+   ones.  When not enough slots are free, the upload waits in a bounded FIFO queue; a full
+   queue, or a wait that times out, is a 503.
+
+Limits and counters are per worker process; nothing is shared between workers, so each
+configured limit applies to every worker separately.  Clients are identified by
+batch_processing.clients.client_identity, which sees through trusted proxies.  stats()
+reports queue depth, slots in use and rejection counts for tuning.
+"""
+import logging
+import math
+import threading
+import time
+from collections import Counter, deque
+
+from django.conf import settings
+
+logger = logging.getLogger(__name__)
+
+MAX_CLIENT_BUCKETS = 1024
+
+
+class AdmissionRejected(Exception):
+    """
+    Raise this when a request may not proceed.  Carries the HTTP status and Retry-After seconds.
+    """
+    def __init__(self, status, retry_after, reason):
+        self.status = status
+        self.retry_after = max(1, int(math.ceil(retry_after)))
+        self.reason = reason
+
+    def __str__(self):
+        return repr(self.reason)
+
+
+class TokenBucket:
+    """
+    Refills at rate tokens per second, up to capacity.  Not thread safe on its own.
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def refill(self, rate, capacity):
+        now = time.monotonic()
+        # Pick up any change in settings
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = min(capacity, self.tokens + (now - self.updated) * rate)
+        self.updated = now
+
+    def wait_for(self, amount):
+        """
+        :return: seconds until amount tokens are available, 0 if they are now.  Amounts over
+            capacity only wait for a full bucket
+        """
+        shortfall = min(amount, self.capacity) - self.tokens
+        if shortfall <= 0:
+            return 0
+        return shortfall / self.rate
+
+    @property
+    def full(self):
+        return self.tokens >= self.capacity
+
+
+class AdmissionTicket:
+    def __init__(self, client, size, slots, buckets):
+        self.client = client
+        self.size = size
+        self.slots = slots
+        self.buckets = buckets  # token buckets to charge size to on admission
+        self.admitted = False
+
+
+class AdmissionController:
+    """
+    Per-process admission state.  Settings are read on every call, so they can be changed
+    at runtime (and overridden in tests).
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._slots_in_use = 0
+        self._client_requests = Counter()  # client -> requests admitted or queued
+        self._queue = deque()
+        self._global_bucket = None
+        self._client_buckets = {}
+        self._counters = Counter()
+        self._max_queue_depth = 0
+
+    def _setting(self, name, default):
+        return getattr(settings, name, default)
+
+    def _rate_buckets(self, client):
+        """
+        :return: [(bucket, status, reason), ...] for the rate limits that apply to this client,
+            refilled to now
+        """
+        rate = self._setting('ADMISSION_BYTES_PER_SECOND', 0)
+        capacity = self._setting('ADMISSION_BURST_BYTES', rate)
+        client_rate = self._setting('ADMISSION_CLIENT_BYTES_PER_SECOND', 0)
+        client_capacity = self._setting('ADMISSION_CLIENT_BURST_BYTES', client_rate)
+
+        buckets = []
+        if client_rate:
+            bucket = self._client_buckets.get(client)
+            if bucket is None:
+                if len(self._client_buckets) >= MAX_CLIENT_BUCKETS:
+                    self._prune_client_buckets(client_rate, client_capacity)
+                bucket = self._client_buckets[client] = TokenBucket(client_rate, client_capacity)
+            bucket.refill(client_rate, client_capacity)
+            buckets.append((bucket, 429, 'client_rate'))
+        if rate:
+            if self._global_bucket is None:
+                self._global_bucket = TokenBucket(rate, capacity)
+            self._global_bucket.refill(rate, capacity)
+            buckets.append((self._global_bucket, 503, 'global_rate'))
+        return buckets
+
+    def _check_rates(self, buckets, size):
+        """
+        Raise if any bucket cannot cover size yet.  Takes nothing; see _admit().
+        """
+        for bucket, status, reason in buckets:
+            wait = bucket.wait_for(size)
+            if wait:
+                raise AdmissionRejected(status, wait, reason)
+
+    def _prune_client_buckets(self, rate, capacity):
+        for client, bucket in list(self._client_buckets.items()):
+            bucket.refill(rate, capacity)
+            if bucket.full:
+                del self._client_buckets[client]
+
+    def _slots_for(self, size, total_slots):
+        bytes_per_slot = self._setting('ADMISSION_BYTES_PER_SLOT', 0)
+        if not bytes_per_slot:
+            return 1
+        return min(total_slots, max(1, int(math.ceil(size / bytes_per_slot))))
+
+    def admit(self, client, size):
+        """
+        Block until the request may proceed, or raise AdmissionRejected.
+        :param client: client identity (see batch_processing.clients)
+        :param size: payload size in bytes, from Content-Length
+        :return: AdmissionTicket to hand to release() when the request is done
+        """
+        total_slots = self._setting('ADMISSION_MAX_CONCURRENT', 8)
+        per_client = self._setting('ADMISSION_MAX_CONCURRENT_PER_CLIENT', 2)
+        queue_size = self._setting('ADMISSION_QUEUE_SIZE', 16)
+        queue_timeout = self._setting('ADMISSION_QUEUE_TIMEOUT_SECONDS', 10)
+        max_size = self._setting('ADMISSION_MAX_UPLOAD_BYTES', 0)
+
+        with self._condition:
+            try:
+                if max_size and size > max_size:
+                    raise AdmissionRejected(413, 0, 'too_large')
+                if self._client_requests[client] >= per_client:
+                    raise AdmissionRejected(429, 1, 'client_concurrency')
+                ticket = AdmissionTicket(client, size, self._slots_for(size, total_slots),
+                                         self._rate_buckets(client))
+                self._check_rates(ticket.buckets, size)
+                if not self._queue and self._slots_in_use + ticket.slots <= total_slots:
+                    self._admit(ticket)
+                    return ticket
+                if len(self._queue) >= queue_size:
+                    raise AdmissionRejected(503, queue_timeout, 'queue_full')
+            except AdmissionRejected as e:
+                self._counters[f'rejected_{e.reason}'] += 1
+                raise
+
+            self._queue.append(ticket)
+            self._client_requests[client] += 1
+            self._max_queue_depth = max(self._max_queue_depth, len(self._queue))
+            self._counters['queued'] += 1
+            deadline = time.monotonic() + queue_timeout
+            try:
+                while not (self._queue[0] is ticket and
+                           self._slots_in_use + ticket.slots <= total_slots):
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self._counters['rejected_queue_timeout'] += 1
+                        raise AdmissionRejected(503, queue_timeout, 'queue_timeout')
+                    self._condition.wait(remaining)
+            except AdmissionRejected:
+                self._forget_client_request(client)
+                raise
+            finally:
+                self._queue.remove(ticket)
+                # Whoever is now at the head may be able to go
+                self._condition.notify_all()
+            self._client_requests[client] -= 1
+            self._admit(ticket)
+            return ticket
+
+    def _admit(self, ticket):
+        # Charged only now, so uploads turned away from the queue cost the client nothing
+        for bucket, _status, _reason in ticket.buckets:
+            bucket.refill(bucket.rate, bucket.capacity)
+            bucket.tokens -= ticket.size
+        self._slots_in_use += ticket.slots
+        self._client_requests[ticket.client] += 1
+        self._counters['admitted'] += 1
+        ticket.admitted = True
+
+    def release(self, ticket):
+        with self._condition:
+            if not ticket.admitted:
+                return
+            ticket.admitted = False
+            self._slots_in_use -= ticket.slots
+            self._forget_client_request(ticket.client)
+            self._condition.notify_all()
+
+    def _forget_client_request(self, client):
+        self._client_requests[client] -= 1
+        if self._client_requests[client] <= 0:
+            del self._client_requests[client]
+
+    def stats(self):
+        with self._condition:
+            return {
+                'slots_in_use': self._slots_in_use,
+                'slots_total': self._setting('ADMISSION_MAX_CONCURRENT', 8),
+                'queue_depth': len(self._queue),
+                'max_queue_depth': self._max_queue_depth,
+                'active_clients': len(self._client_requests),
+                'counters': dict(self._counters),
+            }
+
+
+admission_controller = AdmissionController()
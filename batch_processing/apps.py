@@ -0,0 +1,31 @@
+"""
+Application configuration for the batch processing module
+"""
+import logging
+
+from django.apps import AppConfig
+from django.db import connections
+from django.db.models.signals import pre_migrate
+
+logger = logging.getLogger(__name__)
+
+
+def create_database_extensions(using='default', **kwargs):
+    """
+    The trigram index on Batch_Object_Data_Item.value needs pg_trgm, which has to exist
+    before the index is created.  pg_trgm is a trusted extension (PostgreSQL 13+), so the
+    database owner can create it.
+    """
+    connection = connections[using]
+    if connection.vendor != 'postgresql':
+        return
+    with connection.cursor() as cursor:
+        cursor.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    logger.debug(f'Ensured pg_trgm extension on database {using}')
+
+
+class BatchProcessingConfig(AppConfig):
+    name = 'batch_processing'
+
+    def ready(self):
+        pre_migrate.connect(create_database_extensions, sender=self)
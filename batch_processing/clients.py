@@ -0,0 +1,41 @@
+"""
+Identifying API clients
+"""
+import hashlib
+
+from django.conf import settings
+
+
+def client_address(request):
+    """
+    The client's IP address.  Behind settings.TRUSTED_PROXY_COUNT reverse proxies, each of
+    which appends the address it received the request from to X-Forwarded-For, that is the
+    entry the outermost trusted proxy added; REMOTE_ADDR is only the nearest proxy.  Entries
+    further left are whatever the client chose to send, so they are never used.
+    """
+    proxies = getattr(settings, 'TRUSTED_PROXY_COUNT', 0)
+    forwarded = [address.strip() for address in
+                 request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if address.strip()]
+    if proxies and forwarded:
+        return forwarded[-min(proxies, len(forwarded))]
+    return request.META.get('REMOTE_ADDR', '')
+
+
+def client_identity(request):
+    """
+    A stable identifier for the client making a request: the user if authenticated, otherwise
+    the credentials it sent, otherwise its address.
+    In a DRF view, pass the DRF Request: its user comes from the API authenticators (HTTP Basic
+    as well as the session), where the Django request only knows about the session.  Before
+    DRF has authenticated the request (in middleware), an HTTP Basic client is known by a hash
+    of its Authorization header, so clients sharing an address (or a proxy) are still told
+    apart.  The credentials are not checked; a client sending made-up ones only identifies
+    itself differently.
+    """
+    user = getattr(request, 'user', None)
+    if user is not None and user.is_authenticated:
+        return f'user:{user.pk}'
+    authorization = request.META.get('HTTP_AUTHORIZATION')
+    if authorization:
+        return f"auth:{hashlib.sha256(authorization.encode('latin-1', 'replace')).hexdigest()[:32]}"
+    return f'addr:{client_address(request)}'
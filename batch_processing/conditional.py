@@ -0,0 +1,77 @@
+"""
+HTTP conditional request support (ETag / If-None-Match) for the retrieval views.
+
+Every Batch_Object carries a content_hash computed at ingest from its data, which is the
+object's strong ETag.  A filtered list's ETag is a hash over the primary keys and content
+hashes of the objects it contains, so it changes whenever an object joins, leaves or changes.
+Either can be checked without loading any data items.
+"""
+import hashlib
+import json
+
+from django.conf import settings
+from django.utils.http import parse_etags, quote_etag
+
+
+def content_hash(data_pairs):
+    """
+    Hash an object's data the way it is stored: values are kept as strings (or NULL),
+    so 20.34 and "20.34" hash alike, just as they read back alike.
+    :param data_pairs: iterable of (key, value), in storage order
+    :return: hex digest
+    """
+    canonical = [[key, None if value is None else str(value)] for key, value in data_pairs]
+    return hashlib.sha256(
+        json.dumps(canonical, separators=(',', ':')).encode('utf-8')
+    ).hexdigest()
+
+
+def object_etag(object_content_hash):
+    """
+    :return: quoted strong ETag, or None for objects stored before content hashes existed
+    """
+    if not object_content_hash:
+        return None
+    return quote_etag(object_content_hash)
+
+
+def collection_etag(pk_hash_pairs):
+    """
+    :param pk_hash_pairs: (object primary key, content_hash) for every object in the collection
+    :return: quoted strong ETag, or None if any object has no content hash
+    """
+    digest = hashlib.sha256()
+    for pk, object_content_hash in sorted(pk_hash_pairs):
+        if not object_content_hash:
+            return None
+        digest.update(f'{pk}:{object_content_hash}\n'.encode('ascii'))
+    return quote_etag(digest.hexdigest())
+
+
+def etag_matches(request, etag):
+    """
+    Does the request's If-None-Match header match this ETag?
+    Uses the weak comparison RFC 7232 prescribes for If-None-Match.
+    """
+    header = request.META.get('HTTP_IF_NONE_MATCH')
+    if not header or etag is None:
+        return False
+    etags = parse_etags(header)
+    if etags == ['*']:
+        return True
+    return etag in (tag[2:] if tag.startswith('W/') else tag for tag in etags)
+
+
+def apply_cache_headers(request, response, etag=None):
+    """
+    Set the ETag and the Cache-Control header configured for this route in
+    settings.CACHE_CONTROL (keyed by URL name).
+    :return: the response
+    """
+    if etag is not None:
+        response['ETag'] = etag
+    url_name = request.resolver_match.url_name if request.resolver_match else None
+    cache_control = getattr(settings, 'CACHE_CONTROL', {}).get(url_name)
+    if cache_control:
+        response['Cache-Control'] = cache_control
+    return response
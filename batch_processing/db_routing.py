@@ -0,0 +1,159 @@
+"""
+Read/write database routing.
+
+Writes always go to the primary ('default').  Reads go to the primary as well, except inside a
+view that opts in with ReplicaReadMixin; those reads go to one of settings.DATABASE_REPLICAS,
+picked round-robin or by lowest recent query latency (settings.DATABASE_REPLICA_STRATEGY).
+
+A client that has just written (ingested or deleted a batch) is pinned to the primary for
+settings.DATABASE_READ_YOUR_WRITES_SECONDS, so it never reads from a replica that has not
+caught up with its own write yet.  Pins live in the default cache, so with several worker
+processes that cache needs to be shared (memcached, redis, database) for pins to be seen by
+every worker.
+"""
+import itertools
+import logging
+import threading
+import time
+from contextlib import ExitStack, contextmanager
+from contextvars import ContextVar
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+from batch_processing.clients import client_identity
+
+logger = logging.getLogger(__name__)
+
+LATENCY_SMOOTHING = 0.2
+
+_read_alias = ContextVar('batch_processing_read_alias', default=None)
+_round_robin = itertools.count()
+_latency_lock = threading.Lock()
+_latency = {}  # alias -> (smoothed seconds per query, time.monotonic() of the last sample)
+
+
+class ReplicaRouter:
+    """
+    Sends reads to the replica chosen for the current request, if there is one.
+    """
+
+    def db_for_read(self, model, **hints):
+        return _read_alias.get()
+
+    def db_for_write(self, model, **hints):
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Replicas hold the same data as the primary
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        if db in getattr(settings, 'DATABASE_REPLICAS', []):
+            return False
+        return None
+
+
+def _latency_max_age():
+    return getattr(settings, 'DATABASE_REPLICA_LATENCY_MAX_AGE_SECONDS', 30)
+
+
+def record_latency(alias, seconds):
+    now = time.monotonic()
+    with _latency_lock:
+        previous = _latency.get(alias)
+        if previous is None or now - previous[1] > _latency_max_age():
+            _latency[alias] = (seconds, now)
+        else:
+            _latency[alias] = (previous[0] + LATENCY_SMOOTHING * (seconds - previous[0]), now)
+
+
+def choose_replica():
+    """
+    :return: alias of the replica to read from, or None if there are no replicas
+    """
+    replicas = getattr(settings, 'DATABASE_REPLICAS', [])
+    if not replicas:
+        return None
+    if getattr(settings, 'DATABASE_REPLICA_STRATEGY', 'round_robin') == 'least_latency':
+        now = time.monotonic()
+        max_age = _latency_max_age()
+
+        def recent_latency(alias):
+            # Only the replica we pick gets new figures.  Replicas we have no recent figures for
+            # count as fastest, so each gets tried (again) rather than shunned for good.
+            figure = _latency.get(alias)
+            if figure is None or now - figure[1] > max_age:
+                return 0.0
+            return figure[0]
+
+        with _latency_lock:
+            return min(replicas, key=recent_latency)
+    return replicas[next(_round_robin) % len(replicas)]
+
+
+def _client_key(request):
+    return f'batch_processing:pin:{client_identity(request)}'
+
+
+def pin_to_primary(request):
+    """
+    Call after a client writes, so its reads stay on the primary until replicas catch up.
+    :param request: the DRF Request, so the client is identified as ReplicaReadMixin sees it
+    """
+    if not getattr(settings, 'DATABASE_REPLICAS', []):
+        return
+    cache.set(_client_key(request), True,
+              getattr(settings, 'DATABASE_READ_YOUR_WRITES_SECONDS', 10))
+
+
+def is_pinned_to_primary(request):
+    return bool(cache.get(_client_key(request)))
+
+
+@contextmanager
+def read_from_replica(request):
+    """
+    Route reads made inside this block to a replica, unless the client is pinned to the primary.
+    Yields the alias chosen, or None when reads stay on the primary.
+    """
+    if not getattr(settings, 'DATABASE_REPLICAS', []) or is_pinned_to_primary(request):
+        yield None
+        return
+    alias = choose_replica()
+
+    def timer(execute, sql, params, many, context):
+        started = time.monotonic()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            record_latency(alias, time.monotonic() - started)
+
+    token = _read_alias.set(alias)
+    try:
+        with connections[alias].execute_wrapper(timer):
+            yield alias
+    finally:
+        _read_alias.reset(token)
+
+
+class ReplicaReadMixin:
+    """
+    Mix into a read-only DRF view so its database reads go to a replica.
+
+    The replica is chosen in initial(), once DRF has authenticated the request, so the pin check
+    identifies the client by the same DRF Request (and the same user) that pin_to_primary() was
+    given when the client wrote.  Authentication itself reads from the primary.
+    """
+
+    def dispatch(self, request, *args, **kwargs):
+        with ExitStack() as read_routing:
+            self._read_routing = read_routing
+            return super().dispatch(request, *args, **kwargs)
+
+    def initial(self, request, *args, **kwargs):
+        super().initial(request, *args, **kwargs)
+        alias = self._read_routing.enter_context(read_from_replica(request))
+        if alias is not None:
+            logger.debug(f'Reading from replica {alias}')
@@ -0,0 +1,115 @@
+"""
+Set-based deletion of batches.
+
+Deleting a Batch through the ORM cascade pulls every Batch_Object and Batch_Object_Data_Item
+into Python before issuing the deletes.  Here we go straight to SQL instead, in bounded chunks
+of objects.  Each chunk is its own short transaction that removes a set of objects completely:
+their data items, the objects themselves, and a DELETED change log entry for each.  Locks are
+held briefly, we sleep between chunks to give replicas a chance to keep up, and no reader ever
+sees an object with only some of its data items.
+
+Nothing is marked or remembered between chunks.  The batch row is removed last, so if we are
+interrupted, running the same deletion again simply carries on where the last one stopped.
+Callers that must answer promptly (the DELETE route) pass a time limit; we stop at the first
+chunk boundary past it and report the deletion as incomplete, for the caller to repeat.
+"""
+import logging
+import time
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from batch_processing.models import Batch, Batch_Object, Batch_Object_Data_Item, Object_Change_Log
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 1000
+DEFAULT_THROTTLE_SECONDS = 0.1
+
+
+def delete_batches(batch_pks, chunk_size=None, throttle=None, progress=None, time_limit=None):
+    """
+    Delete batches, their objects and their data items with set-based SQL.
+    :param batch_pks: primary keys of the Batch rows to delete
+    :param chunk_size: objects per chunk, deleted together with their data items.  Defaults to
+        settings.BATCH_DELETE_CHUNK_SIZE
+    :param throttle: seconds to sleep between chunks.  Defaults to
+        settings.BATCH_DELETE_THROTTLE_SECONDS
+    :param progress: optional callable(label, deleted_in_chunk, deleted_so_far)
+    :param time_limit: seconds after which to stop at the next chunk boundary.  None runs to the
+        end
+    :return: dictionary of row counts deleted, by table, and 'complete': whether every batch is
+        gone.  If not, call again with the same batches to carry on
+    """
+    if chunk_size is None:
+        chunk_size = getattr(settings, 'BATCH_DELETE_CHUNK_SIZE', DEFAULT_CHUNK_SIZE)
+    if throttle is None:
+        throttle = getattr(settings, 'BATCH_DELETE_THROTTLE_SECONDS', DEFAULT_THROTTLE_SECONDS)
+    if chunk_size < 1:
+        raise ValueError('chunk_size must be at least 1')
+    if throttle < 0:
+        raise ValueError('throttle must not be negative')
+    qn = connection.ops.quote_name
+    batch_table = qn(Batch._meta.db_table)
+    object_table = qn(Batch_Object._meta.db_table)
+    item_table = qn(Batch_Object_Data_Item._meta.db_table)
+    change_table = qn(Object_Change_Log._meta.db_table)
+    deadline = None if time_limit is None else time.monotonic() + time_limit
+
+    # A chunk is the batch's objects up to and including a given object id.  Objects are never
+    # added to a batch after it is stored, so every statement below sees the same set
+    delete_items = (
+        f'DELETE FROM {item_table} WHERE object_id IN ('
+        f'SELECT id FROM {object_table} WHERE batch_id = %s AND id <= %s)'
+    )
+    log_objects = (
+        f'INSERT INTO {change_table} (object_pk, object_identifier, batch_identifier, action) '
+        f"SELECT o.id, o.object_identifier, b.batch_identifier, '{Object_Change_Log.DELETED}' "
+        f'FROM {object_table} o JOIN {batch_table} b ON o.batch_id = b.id '
+        f'WHERE o.batch_id = %s AND o.id <= %s ORDER BY o.id'
+    )
+    delete_objects = f'DELETE FROM {object_table} WHERE batch_id = %s AND id <= %s'
+
+    counts = {'batches': 0, 'objects': 0, 'data_items': 0, 'complete': False}
+    for index, batch_pk in enumerate(batch_pks):
+        if index and deadline is not None and time.monotonic() >= deadline:
+            return counts
+        logger.debug(f'Deleting batch {batch_pk}')
+        while True:
+            with transaction.atomic():
+                # Locking the chunk's objects keeps a concurrent deletion of the same batch
+                # from logging them a second time
+                object_pks = list(
+                    Batch_Object.objects.select_for_update().filter(batch_id=batch_pk)
+                    .order_by('id').values_list('id', flat=True)[:chunk_size]
+                )
+                if object_pks:
+                    params = [batch_pk, object_pks[-1]]
+                    with connection.cursor() as cursor:
+                        cursor.execute(delete_items, params)
+                        items_deleted = cursor.rowcount
+                        Object_Change_Log.lock_sequence()
+                        cursor.execute(log_objects, params)
+                        cursor.execute(delete_objects, params)
+                        objects_deleted = cursor.rowcount
+            if not object_pks:
+                break
+            counts['data_items'] += items_deleted
+            counts['objects'] += objects_deleted
+            if progress:
+                progress('data_items', items_deleted, counts['data_items'])
+                progress('objects', objects_deleted, counts['objects'])
+            if len(object_pks) < chunk_size:
+                break
+            if deadline is not None and time.monotonic() >= deadline:
+                return counts
+            if throttle:
+                time.sleep(throttle)
+        with transaction.atomic():
+            with connection.cursor() as cursor:
+                cursor.execute(f'DELETE FROM {batch_table} WHERE id = %s', [batch_pk])
+                counts['batches'] += cursor.rowcount
+        if progress:
+            progress('batches', 1, counts['batches'])
+    counts['complete'] = True
+    return counts
@@ -0,0 +1,62 @@
+"""
+Retention pruning for batches.
+
+    python manage.py prune_batches --days 30
+
+Safe to interrupt and run again; see batch_processing.deletion.
+"""
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from batch_processing.deletion import delete_batches
+from batch_processing.models import Batch
+
+
+class Command(BaseCommand):
+    help = 'Delete batches (with their objects and data) older than a given number of days.'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, required=True,
+                            help='Delete batches received more than this many days ago.')
+        parser.add_argument('--chunk-size', type=int, default=None,
+                            help='Objects deleted per chunk, with their data items.')
+        parser.add_argument('--throttle', type=float, default=None,
+                            help='Seconds to sleep between chunks.')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Report what would be deleted without deleting it.')
+
+    def handle(self, *args, **options):
+        if options['days'] < 0:
+            raise CommandError('--days must not be negative.')
+        if options['chunk_size'] is not None and options['chunk_size'] < 1:
+            raise CommandError('--chunk-size must be at least 1.')
+        if options['throttle'] is not None and options['throttle'] < 0:
+            raise CommandError('--throttle must not be negative.')
+        cutoff = timezone.now() - timedelta(days=options['days'])
+        batch_pks = list(
+            Batch.objects.filter(created__lt=cutoff).order_by('id').values_list('id', flat=True)
+        )
+        self.stdout.write(f'{len(batch_pks)} batch(es) received before {cutoff.isoformat()}')
+        if options['dry_run'] or not batch_pks:
+            return
+
+        verbosity = options['verbosity']
+
+        def progress(label, deleted, total):
+            if label == 'batches':
+                self.stdout.write(f'Deleted {total}/{len(batch_pks)} batch(es)')
+            elif verbosity > 1:
+                self.stdout.write(f'  {label}: {deleted} row(s) in chunk, {total} so far')
+
+        counts = delete_batches(
+            batch_pks,
+            chunk_size=options['chunk_size'],
+            throttle=options['throttle'],
+            progress=progress,
+        )
+        self.stdout.write(self.style.SUCCESS(
+            f"Deleted {counts['batches']} batch(es), {counts['objects']} object(s), "
+            f"{counts['data_items']} data item(s)"
+        ))
@@ -0,0 +1,256 @@
+"""
+Middleware for the batch processing module
+"""
+import gzip
+import logging
+import tempfile
+
+from django.conf import settings
+from django.core.handlers.wsgi import LimitedStream
+from django.http import HttpResponse
+from django.urls import Resolver404, resolve
+from django.utils.cache import patch_vary_headers
+from django.utils.text import compress_string
+from django.utils.translation import gettext_lazy as _
+
+from batch_processing.admission import AdmissionRejected, admission_controller
+from batch_processing.clients import client_identity
+from batch_processing.profiling import RequestProfiler, profiling_trigger, save_report
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 64 * 1024
+
+
+def _url_name(request):
+    """
+    URL name of the route a request is for, or None.  Works before the URL has been resolved.
+    """
+    if request.resolver_match is not None:
+        return request.resolver_match.url_name
+    try:
+        return resolve(request.path_info).url_name
+    except Resolver404:
+        return None
+
+
+def _accepted_encodings(request):
+    """
+    Content codings the client accepts, from Accept-Encoding (ignoring any with q=0).
+    """
+    accepted = set()
+    for part in request.META.get('HTTP_ACCEPT_ENCODING', '').split(','):
+        coding, _sep, params = part.strip().partition(';')
+        params = params.replace(' ', '')
+        if params.startswith('q=') and params[2:].strip('0.') == '':
+            continue
+        if coding:
+            accepted.add(coding.lower())
+    return accepted
+
+
+class RequestTooLarge(Exception):
+    """
+    Raise this when a decompressed request body exceeds the configured limit
+    """
+
+
+class RequestDecompressionMiddleware:
+    """
+    Accepts gzip (and, with the zstandard package installed, zstd) compressed request bodies
+    on the ingest routes.
+
+    The body is decompressed a chunk at a time into a spooled temporary file, which stays in
+    memory for small bodies and moves to disk for large ones, and is refused once it grows past
+    settings.REQUEST_DECOMPRESSED_MAX_SIZE.  The view then sees an ordinary uncompressed
+    request, so the JSON and multipart parsers need no changes.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        encoding = request.META.get('HTTP_CONTENT_ENCODING', '').strip().lower()
+        if encoding and encoding != 'identity' and \
+                _url_name(request) in getattr(settings, 'REQUEST_DECOMPRESSION_URL_NAMES', ()):
+            response = self.decompress(request, encoding)
+            if response is not None:
+                return response
+        return self.get_response(request)
+
+    def _reader(self, request, encoding):
+        if encoding in ('gzip', 'x-gzip'):
+            return gzip.GzipFile(fileobj=request, mode='rb')
+        if encoding == 'zstd' and zstandard is not None:
+            return zstandard.ZstdDecompressor().stream_reader(request)
+        return None
+
+    def decompress(self, request, encoding):
+        """
+        Replace the request's body stream with its decompressed content.
+        :return: an error response, or None on success
+        """
+        reader = self._reader(request, encoding)
+        if reader is None:
+            return HttpResponse(
+                _('Unsupported Content-Encoding %(encoding)s.') % {'encoding': encoding},
+                status=415
+            )
+        max_size = getattr(settings, 'REQUEST_DECOMPRESSED_MAX_SIZE', 64 * 1024 * 1024)
+        spool = tempfile.SpooledTemporaryFile(max_size=settings.FILE_UPLOAD_MAX_MEMORY_SIZE)
+        size = 0
+        try:
+            while True:
+                chunk = reader.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                size += len(chunk)
+                if size > max_size:
+                    raise RequestTooLarge(size)
+                spool.write(chunk)
+        except RequestTooLarge:
+            spool.close()
+            logger.error(f'Decompressed request body exceeds {max_size} bytes')
+            return HttpResponse(
+                _('Decompressed request body is too large.'),
+                status=413
+            )
+        except Exception as e:
+            # gzip, zlib and zstandard each raise their own errors for corrupt data
+            spool.close()
+            logger.error(f'Failed to decompress {encoding} request body: {e}')
+            return HttpResponse(
+                _('Request body could not be decompressed.'),
+                status=400
+            )
+        logger.debug(f'Decompressed {encoding} request body to {size} bytes')
+        spool.seek(0)
+        request._stream = LimitedStream(spool, size)
+        request._read_started = False
+        request.META['CONTENT_LENGTH'] = str(size)
+        del request.META['HTTP_CONTENT_ENCODING']
+        return None
+
+
+class ResponseCompressionMiddleware:
+    """
+    Compresses large responses from the retrieval routes, with zstd (if the zstandard package
+    is installed and the client accepts it) or gzip.  Small responses are not worth the CPU.
+
+    A 304 has no body to compress, but gets the same Vary header and ETag as the 200 it stands
+    in for, so caches and clients see one consistent validator.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if response.streaming or response.status_code not in (200, 304) or response.has_header(
+                'Content-Encoding'):
+            return response
+        if _url_name(request) not in getattr(settings, 'RESPONSE_COMPRESSION_URL_NAMES', ()):
+            return response
+        patch_vary_headers(response, ('Accept-Encoding',))
+
+        accepted = _accepted_encodings(request)
+        if zstandard is not None and 'zstd' in accepted:
+            encoding = 'zstd'
+        elif 'gzip' in accepted:
+            encoding = 'gzip'
+        else:
+            return response
+        # The compressed bytes differ from what a strong ETag describes.  Whether a given
+        # response ends up compressed depends on its size, which a 304 cannot know, so weaken the
+        # ETag for every response to a client that accepts compression.
+        etag = response.get('ETag')
+        if etag and etag.startswith('"'):
+            response['ETag'] = 'W/' + etag
+        if response.status_code != 200 or \
+                len(response.content) < getattr(settings, 'RESPONSE_COMPRESSION_MIN_SIZE', 1024):
+            return response
+
+        if encoding == 'zstd':
+            compressed = zstandard.ZstdCompressor().compress(response.content)
+        else:
+            compressed = compress_string(response.content)
+        if len(compressed) >= len(response.content):
+            return response
+
+        response.content = compressed
+        response['Content-Length'] = str(len(compressed))
+        response['Content-Encoding'] = encoding
+        return response
+
+
+class AdmissionControlMiddleware:
+    """
+    Applies batch_processing.admission limits to the ingest routes, before the body is read.
+    Must come before RequestDecompressionMiddleware, so limits apply to the bytes on the wire.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if request.method != 'POST' or \
+                _url_name(request) not in getattr(settings, 'ADMISSION_URL_NAMES', ()):
+            return self.get_response(request)
+        try:
+            size = int(request.META.get('CONTENT_LENGTH') or '')
+        except ValueError:
+            return HttpResponse(
+                _('Uploads must give a Content-Length.'),
+                status=411
+            )
+        client = client_identity(request)
+        try:
+            ticket = admission_controller.admit(client, size)
+        except AdmissionRejected as e:
+            logger.warning(f'Rejected {size} byte upload from {client}: {e.reason}')
+            if e.status == 413:
+                return HttpResponse(
+                    _('Upload is too large. The limit is %(limit)d bytes.') % {
+                        'limit': getattr(settings, 'ADMISSION_MAX_UPLOAD_BYTES', 0)},
+                    status=413
+                )
+            response = HttpResponse(
+                _('Too many uploads in progress. Try again later.'),
+                status=e.status
+            )
+            response['Retry-After'] = str(e.retry_after)
+            return response
+        try:
+            return self.get_response(request)
+        finally:
+            admission_controller.release(ticket)
+
+
+class ProfilingMiddleware:
+    """
+    Profiles requests picked by batch_processing.profiling and stores a report for each.
+    Put it first, so the report covers the other middleware too.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        trigger = profiling_trigger(request)
+        if trigger is None:
+            return self.get_response(request)
+        profiler = RequestProfiler()
+        response, duration = profiler.run(self.get_response, request)
+        try:
+            name = save_report(request, response, profiler, duration, trigger)
+            logger.info(f'Saved profiling report {name} for {request.method} {request.path}')
+            if trigger == 'header':
+                response['X-Profile-Report'] = name
+        except Exception as e:
+            logger.error(f'Failed to save profiling report: {e}')
+        return response
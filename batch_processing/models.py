@@ -1,7 +1,8 @@
 import logging
 
 from django.conf import settings
-from django.db import models
+from django.contrib.postgres.indexes import GinIndex
+from django.db import connection, models
 from django.db.models import fields
 
 from django.utils.translation import gettext_lazy as _
@@ -44,6 +45,16 @@ class Batch_Object_Data_Item(models.Model):
         help_text=_("The object this data item is associated with."),
     )
 
+    class Meta:
+        indexes = [
+            # Substring search (object_list?value__contains=) uses LIKE '%...%', which only a
+            # trigram index can serve.  Needs the pg_trgm extension; see batch_processing.apps.
+            # Prefix search (value__startswith=) needs no extra index: on PostgreSQL, db_index on
+            # a CharField already adds a varchar_pattern_ops ("_like") index alongside the
+            # plain one.
+            GinIndex(name='data_item_value_trgm', fields=['value'], opclasses=['gin_trgm_ops']),
+        ]
+
 class Batch_Object(models.Model):
     # Schema gives no limit on object ID size.  Using 128 as it seems adequate without further requirements
     # While object_id looks like it should be unique, there is no such constraint mentioned in the requirements
@@ -66,6 +77,18 @@ class Batch_Object(models.Model):
         on_delete=models.CASCADE,
         help_text=_("The batch this object is associated with."),
     )
+    # Hash of the object's data, set at ingest, and used as its ETag
+    # (see batch_processing.conditional).  Objects are never modified after ingest.
+    content_hash = models.CharField(
+        max_length=64,
+        null=False,
+        blank=True,
+        default='',
+        help_text=_(
+            "SHA-256 of the object's data"
+        ),
+        verbose_name=_("Content hash"),
+    )
     # We could speed up object retrieval at the expense of DB space by storing the raw Object JSON
     # here.
 
@@ -84,3 +107,81 @@ class Batch(models.Model):
         ),
         verbose_name=_("Batch ID"),
     )
+    # Used for retention pruning (see batch_processing.deletion)
+    created = models.DateTimeField(
+        auto_now_add=True,
+        db_index=True,
+        help_text=_(
+            "When the batch was received"
+        ),
+        verbose_name=_("Created"),
+    )
+
+class Object_Change_Log(models.Model):
+    # One row per object created or deleted.  The auto-increment id doubles as the change
+    # sequence number: readers remember the highest id they have seen and ask for anything newer.
+    # That only works if ids become visible in order; see lock_sequence().
+    # Objects are never updated in place, so there is no 'updated' action.
+    CREATED = 'C'
+    DELETED = 'D'
+    # Any fixed number will do, as long as everything that writes to the log uses it
+    SEQUENCE_LOCK_ID = 7301
+    ACTION_CHOICES = (
+        (CREATED, _('Created')),
+        (DELETED, _('Deleted')),
+    )
+    # Not a foreign key -- the log has to outlive the objects it describes
+    object_pk = models.BigIntegerField(
+        null=False,
+        blank=False,
+        help_text=_(
+            "Primary key of the Batch_Object that changed"
+        ),
+        verbose_name=_("Object primary key"),
+    )
+    object_identifier = models.CharField(
+        unique=False,
+        max_length=128,
+        null=False,
+        blank=False,
+        help_text=_(
+            "Object identifier"
+        ),
+        verbose_name=_("Object ID"),
+    )
+    batch_identifier = models.CharField(
+        unique=False,
+        max_length=128,
+        null=False,
+        blank=False,
+        help_text=_(
+            "Identifier of the batch the object belongs to"
+        ),
+        verbose_name=_("Batch ID"),
+    )
+    action = models.CharField(
+        max_length=1,
+        choices=ACTION_CHOICES,
+        null=False,
+        blank=False,
+        help_text=_(
+            "What happened to the object"
+        ),
+        verbose_name=_("Action"),
+    )
+
+    @classmethod
+    def lock_sequence(cls):
+        """
+        Call inside the writing transaction, right before adding rows to the log.
+
+        Ids are handed out at INSERT but only become visible at commit, so two transactions
+        writing at once could commit out of order, and a reader that had already moved past the
+        higher ids would never see the lower ones.  A transaction-level advisory lock, held until
+        commit, makes writers take ids one transaction at a time, so they become visible in
+        order.  Keep the work between this call and the commit short.  SQLite allows only one
+        writer at a time anyway.
+        """
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute('SELECT pg_advisory_xact_lock(%s)', [cls.SEQUENCE_LOCK_ID])
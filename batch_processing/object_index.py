@@ -0,0 +1,264 @@
+"""
+Optional in-process inverted index over Batch_Object_Data_Item.
+
+Each (key, value) pair, each key and each value maps to a bitmap of Batch_Object primary keys,
+so exact-match filters become bitmap intersections, unions and differences and never touch
+the database.  The index is built in a background thread the first time it is asked for and
+is then kept current by replaying the Object_Change_Log that ingest and deletion write.
+
+Bitmaps are pyroaring BitMap64s when pyroaring is installed (object primary keys are 64-bit
+BigAutoFields, too wide for the 32-bit BitMap).  Without it we fall back to plain Python sets,
+which support the same operators but use a good deal more memory.
+
+Turn it on with settings.OBJECT_INDEX_ENABLED.  Whenever the index is cold, still building,
+or too far behind the change log, get_object_index() returns None and callers use SQL.
+"""
+import logging
+import threading
+import time
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
+
+from batch_processing.conditional import collection_etag
+from batch_processing.models import Batch_Object, Batch_Object_Data_Item, Object_Change_Log
+
+try:
+    from pyroaring import BitMap64 as BitMap
+except ImportError:
+    BitMap = set
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SYNC_SECONDS = 1.0
+DEFAULT_MAX_LAG = 10000
+
+
+class ObjectIndex:
+    """
+    Inverted index from key/value data to object primary keys.
+    All public methods are thread safe.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        # Held for a whole sync, database reads included; _lock only while applying the results
+        self._sync_lock = threading.Lock()
+        self._pairs = {}   # (key, value) -> bitmap
+        self._keys = {}    # key -> bitmap
+        self._values = {}  # value -> bitmap
+        self._all = BitMap()
+        # pk -> (object_identifier, [(key, value), ...], content_hash) so results (and their
+        # ETags) can be served from memory
+        self._objects = {}
+        self.sequence = 0
+        self.ready = False
+        self.caught_up = False
+        self.synced_at = 0.0
+
+    def _add(self, pk, object_identifier, data, object_content_hash):
+        if pk in self._objects:
+            # Already loaded by the initial build; the change log can repeat it
+            return
+        self._objects[pk] = (object_identifier, data, object_content_hash)
+        self._all.add(pk)
+        for key, value in data:
+            self._pairs.setdefault((key, value), BitMap()).add(pk)
+            self._keys.setdefault(key, BitMap()).add(pk)
+            self._values.setdefault(value, BitMap()).add(pk)
+
+    def _remove(self, pk):
+        entry = self._objects.pop(pk, None)
+        if entry is None:
+            return
+        self._all.discard(pk)
+        for key, value in entry[1]:
+            for postings, term in ((self._pairs, (key, value)), (self._keys, key),
+                                   (self._values, value)):
+                bitmap = postings.get(term)
+                if bitmap is not None:
+                    bitmap.discard(pk)
+                    if not bitmap:
+                        del postings[term]
+
+    def _load(self, object_pks=None):
+        """
+        Read objects and their data items from the database.
+        :param object_pks: restrict to these objects.  None loads everything
+        :return: dictionary of pk -> (object_identifier, [(key, value), ...], content_hash)
+        """
+        objects = Batch_Object.objects.all()
+        items = Batch_Object_Data_Item.objects.all()
+        if object_pks is not None:
+            objects = objects.filter(id__in=object_pks)
+            items = items.filter(object_id__in=object_pks)
+        loaded = {}
+        for pk, object_identifier, object_content_hash in objects.values_list(
+                'id', 'object_identifier', 'content_hash').iterator():
+            loaded[pk] = (object_identifier, [], object_content_hash)
+        for object_pk, key, value in items.order_by('id').values_list(
+                'object_id', 'key', 'value').iterator():
+            if object_pk in loaded:
+                loaded[object_pk][1].append((key, value))
+        return loaded
+
+    def build(self):
+        """
+        Load the whole index from the database, then catch up on the change log.
+        """
+        started = time.monotonic()
+        # Take the sequence first; anything logged while we load is replayed afterwards.  Change
+        # log ids become visible in order (Object_Change_Log.lock_sequence), so every change up
+        # to this one is already committed and covered by the load.
+        sequence = Object_Change_Log.objects.aggregate(Max('id'))['id__max'] or 0
+        loaded = self._load()
+        with self._lock:
+            for pk, entry in loaded.items():
+                self._add(pk, *entry)
+            self.sequence = sequence
+        self.sync(force=True)
+        with self._lock:
+            self.ready = True
+        logger.info(f'Built object index of {len(loaded)} objects in '
+                    f'{time.monotonic() - started:.1f}s')
+
+    def sync(self, force=False):
+        """
+        Apply change log entries written since the last sync.
+        Does nothing if we synced less than settings.OBJECT_INDEX_SYNC_SECONDS ago, unless forced.
+        If another thread is already syncing, returns straight away rather than wait for it,
+        unless forced.
+        :return: True if the index is now current, False if it is still catching up
+        """
+        sync_seconds = getattr(settings, 'OBJECT_INDEX_SYNC_SECONDS', DEFAULT_SYNC_SECONDS)
+        max_lag = getattr(settings, 'OBJECT_INDEX_MAX_LAG', DEFAULT_MAX_LAG)
+        if not self._sync_lock.acquire(blocking=force):
+            return self.caught_up
+        try:
+            with self._lock:
+                if not force and time.monotonic() - self.synced_at < sync_seconds:
+                    return True
+                sequence = self.sequence
+            # Read without holding _lock, so select() and serialize() carry on meanwhile
+            changes = list(
+                Object_Change_Log.objects.filter(id__gt=sequence).order_by('id').values_list(
+                    'id', 'object_pk', 'action')[:max_lag + 1]
+            )
+            caught_up = len(changes) <= max_lag
+            changes = changes[:max_lag]
+            created = [object_pk for _, object_pk, action in changes
+                       if action == Object_Change_Log.CREATED]
+            loaded = self._load(created) if created else {}
+            with self._lock:
+                for sequence, object_pk, action in changes:
+                    if action == Object_Change_Log.CREATED:
+                        if object_pk in loaded:
+                            self._add(object_pk, *loaded[object_pk])
+                    else:
+                        self._remove(object_pk)
+                    self.sequence = sequence
+                self.caught_up = caught_up
+                if caught_up:
+                    self.synced_at = time.monotonic()
+            return caught_up
+        finally:
+            self._sync_lock.release()
+
+    def _term(self, key, value):
+        if key is not None and value is not None:
+            return self._pairs.get((key, value), BitMap())
+        if key is not None:
+            return self._keys.get(key, BitMap())
+        if value is not None:
+            return self._values.get(value, BitMap())
+        return self._all
+
+    def select(self, all_of=(), any_of=(), none_of=()):
+        """
+        Find objects by exact key/value terms.
+        Each term is a (key, value) tuple; None in either place matches anything.
+        :param all_of: objects must match every one of these terms (AND)
+        :param any_of: objects must match at least one of these terms, if any are given (OR)
+        :param none_of: objects must match none of these terms (NOT)
+        :return: sorted list of object primary keys
+        """
+        with self._lock:
+            result = BitMap(self._all)
+            for key, value in all_of:
+                result &= self._term(key, value)
+            if any_of:
+                either = BitMap()
+                for key, value in any_of:
+                    either |= self._term(key, value)
+                result &= either
+            for key, value in none_of:
+                result -= self._term(key, value)
+            return sorted(result)
+
+    def serialize(self, object_pks):
+        """
+        Build the same dictionaries the retrieval views return, straight from memory.
+        """
+        with self._lock:
+            return [
+                {
+                    'object_id': self._objects[pk][0],
+                    'data': [{'key': key, 'value': value} for key, value in self._objects[pk][1]],
+                }
+                for pk in object_pks if pk in self._objects
+            ]
+
+    def etag(self, object_pks):
+        """
+        The collection ETag for these objects; see batch_processing.conditional.
+        """
+        with self._lock:
+            return collection_etag(
+                (pk, self._objects[pk][2]) for pk in object_pks if pk in self._objects
+            )
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def _build_in_background(index):
+    try:
+        index.build()
+    except Exception as e:
+        logger.error(f'Failed to build object index: {e}')
+        global _index
+        with _index_lock:
+            # Let the next request try again
+            if _index is index:
+                _index = None
+    finally:
+        connection.close()
+
+
+def get_object_index():
+    """
+    Return the shared ObjectIndex if it is enabled, built and current, otherwise None.
+    The first call starts building it in a background thread.
+    """
+    global _index
+    if not getattr(settings, 'OBJECT_INDEX_ENABLED', False):
+        return None
+    with _index_lock:
+        if _index is None:
+            _index = ObjectIndex()
+            threading.Thread(target=_build_in_background, args=(_index,), daemon=True,
+                             name='object-index-build').start()
+            return None
+        index = _index
+    if not index.ready:
+        return None
+    try:
+        if not index.sync():
+            logger.warning(f'Object index is behind the change log at sequence {index.sequence}')
+            return None
+    except Exception as e:
+        logger.error(f'Failed to sync object index: {e}')
+        return None
+    return index
@@ -0,0 +1,182 @@
+"""
+On-demand request profiling.
+
+A request is profiled when it carries settings.PROFILING_HEADER set to settings.PROFILING_TOKEN,
+or when it is picked at random at settings.PROFILING_SAMPLE_RATE.  For a profiled request we
+record a cProfile profile plus every SQL statement (on every database) with its timing, and
+write the lot as a JSON report in settings.PROFILING_DIR, keeping at most
+settings.PROFILING_MAX_REPORTS of them.  Admin users can list and read reports through the
+batch/profiles/ routes.
+
+Requests that are not profiled pay for one header lookup and, if sampling is on, one random
+number.  Nothing else.
+"""
+import cProfile
+import hmac
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import re
+import time
+import uuid
+from contextlib import ExitStack
+from datetime import datetime, timezone
+
+from django.conf import settings
+from django.db import connections
+
+logger = logging.getLogger(__name__)
+
+# Names are the UTC time to the microsecond, so they sort in the order reports were written,
+# then a random suffix.  Reports from before microseconds were added have seconds only.
+REPORT_NAME_PATTERN = re.compile(r'^[0-9]{8}T[0-9]{6}(?:[0-9]{6})?-[0-9a-f]{32}$')
+MAX_QUERIES = 1000
+PROFILE_LINES = 60
+
+
+def profiling_trigger(request):
+    """
+    :return: why this request should be profiled ('header' or 'sample'), or None
+    """
+    token = getattr(settings, 'PROFILING_TOKEN', '')
+    if token:
+        supplied = request.META.get(getattr(settings, 'PROFILING_HEADER', 'HTTP_X_PROFILE'))
+        try:
+            # Header values arrive as latin-1; compare_digest only takes ASCII strings
+            if supplied and hmac.compare_digest(supplied.encode('latin-1'), token.encode()):
+                return 'header'
+        except UnicodeEncodeError:
+            pass
+    sample_rate = getattr(settings, 'PROFILING_SAMPLE_RATE', 0)
+    if sample_rate and random.random() < sample_rate:
+        return 'sample'
+    return None
+
+
+class RequestProfiler:
+    """
+    Collects a cProfile profile and SQL timings while a request runs.
+    """
+
+    def __init__(self):
+        self.queries = []
+        self.query_count = 0
+        self.query_time = 0.0
+        self.profile = cProfile.Profile()
+        self.profiled = False
+
+    def _record_query(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            duration = time.perf_counter() - started
+            self.query_count += 1
+            self.query_time += duration
+            if len(self.queries) < MAX_QUERIES:
+                self.queries.append({
+                    'database': context['connection'].alias,
+                    'sql': sql,
+                    'many': many,
+                    'duration_ms': round(duration * 1000, 3),
+                })
+
+    def run(self, get_response, request):
+        """
+        :return: (response, seconds taken)
+        """
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for alias in connections:
+                stack.enter_context(connections[alias].execute_wrapper(self._record_query))
+            try:
+                self.profile.enable()
+                self.profiled = True
+            except ValueError as e:
+                # Another profiler is already running in this process; settle for SQL timings
+                logger.warning(f'Could not start cProfile: {e}')
+            try:
+                response = get_response(request)
+            finally:
+                if self.profiled:
+                    self.profile.disable()
+        return response, time.perf_counter() - started
+
+    def profile_text(self):
+        if not self.profiled:
+            return ''
+        stream = io.StringIO()
+        stats = pstats.Stats(self.profile, stream=stream)
+        stats.sort_stats('cumulative').print_stats(PROFILE_LINES)
+        return stream.getvalue()
+
+
+def _report_dir():
+    return getattr(settings, 'PROFILING_DIR', os.path.join(settings.BASE_DIR, 'profiles'))
+
+
+def save_report(request, response, profiler, duration, trigger):
+    """
+    Write a report and drop the oldest ones beyond settings.PROFILING_MAX_REPORTS.
+    :return: the report name
+    """
+    now = datetime.now(timezone.utc)
+    name = f"{now.strftime('%Y%m%dT%H%M%S%f')}-{uuid.uuid4().hex}"
+    report = {
+        'name': name,
+        'created': now.isoformat(),
+        'trigger': trigger,
+        'method': request.method,
+        'path': request.path,
+        'query_string': request.META.get('QUERY_STRING', ''),
+        'status': response.status_code,
+        'duration_ms': round(duration * 1000, 3),
+        'query_count': profiler.query_count,
+        'query_time_ms': round(profiler.query_time * 1000, 3),
+        'queries': profiler.queries,
+        'queries_truncated': profiler.query_count > len(profiler.queries),
+        'profile': profiler.profile_text(),
+    }
+    report_dir = _report_dir()
+    os.makedirs(report_dir, exist_ok=True)
+    with open(os.path.join(report_dir, f'{name}.json'), 'w') as report_file:
+        json.dump(report, report_file)
+
+    max_reports = getattr(settings, 'PROFILING_MAX_REPORTS', 100)
+    for old_name in list_report_names()[max_reports:]:
+        if old_name == name:
+            # Reports written in the same microsecond sort at random; keep the one just written
+            continue
+        try:
+            os.remove(os.path.join(report_dir, f'{old_name}.json'))
+        except OSError as e:
+            logger.warning(f'Could not remove old profiling report {old_name}: {e}')
+    return name
+
+
+def list_report_names():
+    """
+    :return: report names, newest first
+    """
+    try:
+        file_names = os.listdir(_report_dir())
+    except FileNotFoundError:
+        return []
+    names = [file_name[:-len('.json')] for file_name in file_names if file_name.endswith('.json')]
+    return sorted((name for name in names if REPORT_NAME_PATTERN.match(name)), reverse=True)
+
+
+def load_report(name):
+    """
+    :return: the report as a dictionary, or None if there is no such report
+    """
+    if not REPORT_NAME_PATTERN.match(name):
+        return None
+    try:
+        with open(os.path.join(_report_dir(), f'{name}.json')) as report_file:
+            return json.load(report_file)
+    except FileNotFoundError:
+        return None
@@ -0,0 +1,14 @@
+"""
+Tests for batch_processing.
+"""
+from django.test import TestCase, override_settings
+
+
+@override_settings(OBJECT_INDEX_ENABLED=False, PROFILING_SAMPLE_RATE=0, DATABASE_REPLICAS=[])
+class BatchProcessingTestCase(TestCase):
+    """
+    Base for tests that drive the routes.  Reads stay on the primary (a replica connection
+    cannot see what a TestCase has not committed), and the object index and request sampling
+    are off, so every request takes the same path.  Subclasses and tests turn them back on with
+    override_settings of their own.
+    """
@@ -0,0 +1,49 @@
+"""
+Tests for the batch/changes/ feed.
+"""
+from django.urls import reverse
+
+from batch_processing.deletion import delete_batches
+from batch_processing.tests import BatchProcessingTestCase
+from batch_processing.views import store_batch
+
+
+class ChangeFeedTests(BatchProcessingTestCase):
+
+    def changes(self, cursor=0):
+        response = self.client.get(reverse('changes'), {'cursor': cursor})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_entries_identify_objects_uniquely(self):
+        # The same object ID in two batches, then one of the batches deleted
+        data = [{'key': 'color', 'value': 'gold'}]
+        batch_a = store_batch({'batch_id': 'a', 'objects': [{'object_id': 'x', 'data': data}]})
+        store_batch({'batch_id': 'b', 'objects': [{'object_id': 'x', 'data': data}]})
+        delete_batches([batch_a.id], throttle=0)
+
+        changes = self.changes()['changes']
+        self.assertEqual(
+            [(change['action'], change['object_id'], change['batch_id']) for change in changes],
+            [('created', 'x', 'b'), ('deleted', 'x', 'a')])
+        created, deleted = changes
+        self.assertNotEqual(created['object_pk'], deleted['object_pk'])
+
+        # Replaying by object_pk leaves batch b's copy in place
+        live = {}
+        for change in changes:
+            if change['action'] == 'created':
+                live[change['object_pk']] = change
+            else:
+                live.pop(change['object_pk'], None)
+        self.assertEqual([change['batch_id'] for change in live.values()], ['b'])
+
+    def test_cursor_continues_after_last_entry(self):
+        store_batch({'batch_id': 'a', 'objects': [
+            {'object_id': f'x{number}', 'data': [{'key': 'n', 'value': str(number)}]}
+            for number in range(3)
+        ]})
+        first = self.changes()
+        self.assertFalse(first['has_more'])
+        self.assertEqual(first['cursor'], first['changes'][-1]['sequence'])
+        self.assertEqual(self.changes(first['cursor'])['changes'], [])
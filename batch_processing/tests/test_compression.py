@@ -0,0 +1,62 @@
+"""
+Tests for request decompression and response compression (batch_processing.middleware).
+"""
+import gzip
+import json
+
+from django.test import override_settings
+from django.urls import reverse
+
+from batch_processing.tests import BatchProcessingTestCase
+from batch_processing.views import store_batch
+
+
+@override_settings(RESPONSE_COMPRESSION_MIN_SIZE=1)
+class CompressionTests(BatchProcessingTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        store_batch({'batch_id': 'compression', 'objects': [
+            {'object_id': f'x{number}', 'data': [{'key': 'color', 'value': 'gold' * 25}]}
+            for number in range(20)
+        ]})
+
+    def test_304_matches_compressed_200(self):
+        url = reverse('object_list')
+        response = self.client.get(url, {'key': 'color'}, HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        self.assertTrue(response['ETag'].startswith('W/'))
+        self.assertEqual(len(json.loads(gzip.decompress(response.content))), 20)
+
+        revalidated = self.client.get(url, {'key': 'color'}, HTTP_ACCEPT_ENCODING='gzip',
+                                      HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+        self.assertIn('Accept-Encoding', revalidated['Vary'])
+
+    def test_uncompressed_client_keeps_strong_etag(self):
+        url = reverse('object', kwargs={'object_id': 'x0'})
+        response = self.client.get(url)
+        self.assertFalse(response.has_header('Content-Encoding'))
+        self.assertTrue(response['ETag'].startswith('"'))
+
+        revalidated = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(revalidated.status_code, 304)
+        self.assertEqual(revalidated['ETag'], response['ETag'])
+        self.assertIn('Accept-Encoding', revalidated['Vary'])
+
+    def test_unsupported_request_encoding(self):
+        response = self.client.post(reverse('body'), b'{}', content_type='application/json',
+                                    HTTP_CONTENT_ENCODING='br')
+        self.assertEqual(response.status_code, 415)
+        self.assertIn(b'Unsupported Content-Encoding br.', response.content)
+
+    def test_gzip_request_body(self):
+        payload = {'batch_id': 'gzipped', 'objects': [
+            {'object_id': 'gz', 'data': [{'key': 'k', 'value': 'v'}]}]}
+        response = self.client.post(reverse('body'), gzip.compress(json.dumps(payload).encode()),
+                                    content_type='application/json', HTTP_CONTENT_ENCODING='gzip')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(self.client.get(reverse('object', kwargs={'object_id': 'gz'})).json(),
+                         payload['objects'][0])
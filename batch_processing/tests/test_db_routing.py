@@ -0,0 +1,156 @@
+"""
+Tests for read replica routing and read-your-writes pinning (batch_processing.db_routing).
+
+The end-to-end routing tests need a replica alias.  Run them against two local databases with
+e.g. DATABASE_REPLICA_URIS=postgres://localhost/batch_replica; under test the replica mirrors
+the default database.  Without one, they are skipped and the rest still run.
+
+A mirror is a connection of its own, so it cannot see data a TestCase has not committed.  The
+end-to-end tests are TransactionTestCases for that reason, and the other tests read from the
+primary only (batch_processing.tests.BatchProcessingTestCase).
+"""
+import base64
+from unittest import mock
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.db import connections
+from django.test import SimpleTestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from batch_processing import db_routing
+from batch_processing.tests import BatchProcessingTestCase
+from batch_processing.views import store_batch
+
+PAYLOAD = {'batch_id': 'routing', 'objects': [
+    {'object_id': 'routed', 'data': [{'key': 'color', 'value': 'gold'}]}]}
+
+
+@override_settings(DATABASE_REPLICAS=['replica_a', 'replica_b'],
+                   DATABASE_REPLICA_LATENCY_MAX_AGE_SECONDS=30)
+class ChooseReplicaTests(SimpleTestCase):
+
+    def setUp(self):
+        db_routing._latency.clear()
+        self.addCleanup(db_routing._latency.clear)
+
+    def test_round_robin_uses_every_replica(self):
+        with override_settings(DATABASE_REPLICA_STRATEGY='round_robin'):
+            chosen = {db_routing.choose_replica() for _attempt in range(4)}
+        self.assertEqual(chosen, {'replica_a', 'replica_b'})
+
+    @override_settings(DATABASE_REPLICA_STRATEGY='least_latency')
+    def test_least_latency_prefers_faster_replica(self):
+        db_routing.record_latency('replica_a', 0.5)
+        db_routing.record_latency('replica_b', 0.1)
+        self.assertEqual(db_routing.choose_replica(), 'replica_b')
+
+    @override_settings(DATABASE_REPLICA_STRATEGY='least_latency')
+    def test_least_latency_retries_replica_once_figures_go_stale(self):
+        with mock.patch.object(db_routing.time, 'monotonic', return_value=1000.0):
+            db_routing.record_latency('replica_a', 0.5)
+            db_routing.record_latency('replica_b', 0.1)
+        with mock.patch.object(db_routing.time, 'monotonic', return_value=1020.0):
+            # Only replica_b is picked, so only it gets fresh figures
+            db_routing.record_latency('replica_b', 0.1)
+            self.assertEqual(db_routing.choose_replica(), 'replica_b')
+        with mock.patch.object(db_routing.time, 'monotonic', return_value=1040.0):
+            self.assertEqual(db_routing.choose_replica(), 'replica_a')
+            # replica_a has recovered; its first new figure replaces the stale one outright
+            db_routing.record_latency('replica_a', 0.05)
+            self.assertEqual(db_routing.choose_replica(), 'replica_a')
+
+
+def basic_auth(username, password):
+    credentials = base64.b64encode(f'{username}:{password}'.encode()).decode()
+    return {'HTTP_AUTHORIZATION': f'Basic {credentials}'}
+
+
+@override_settings(PASSWORD_HASHERS=['django.contrib.auth.hashers.MD5PasswordHasher'])
+class PinningTests(BatchProcessingTestCase):
+    """
+    Pin checks, with the primary standing in as the only replica.  choose_replica() is only
+    consulted for clients that are not pinned.
+    """
+
+    def setUp(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        User.objects.create_user('writer', 'writer@example.com', 'secret')
+        choose_replica = mock.patch.object(db_routing, 'choose_replica', return_value='default')
+        self.choose_replica = choose_replica.start()
+        self.addCleanup(choose_replica.stop)
+
+    def read(self, **headers):
+        self.choose_replica.reset_mock()
+        response = self.client.get(reverse('object_list'), {'key': 'color'}, **headers)
+        self.assertEqual(response.status_code, 200)
+        return self.choose_replica.called
+
+    @override_settings(DATABASE_REPLICAS=['default'])
+    def test_basic_auth_writer_is_pinned(self):
+        self.assertTrue(self.read(**basic_auth('writer', 'secret')))
+        response = self.client.post(reverse('body'), PAYLOAD, content_type='application/json',
+                                    **basic_auth('writer', 'secret'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(self.read(**basic_auth('writer', 'secret')))
+        # Anonymous clients were not the writer
+        self.assertTrue(self.read())
+
+    @override_settings(DATABASE_REPLICAS=['default'])
+    def test_session_writer_is_pinned(self):
+        self.client.login(username='writer', password='secret')
+        self.client.post(reverse('body'), PAYLOAD, content_type='application/json')
+        self.assertFalse(self.read())
+
+
+def replica_alias():
+    for alias in getattr(settings, 'DATABASE_REPLICAS', []):
+        if alias in settings.DATABASES:
+            return alias
+    return None
+
+
+@override_settings(OBJECT_INDEX_ENABLED=False, PROFILING_SAMPLE_RATE=0)
+class ReplicaRoutingTests(TransactionTestCase):
+    databases = '__all__'
+
+    def setUp(self):
+        self.replica = replica_alias()
+        if self.replica is None:
+            self.skipTest('No replica database configured (set DATABASE_REPLICA_URIS)')
+        cache.clear()
+        self.addCleanup(cache.clear)
+        store_batch(PAYLOAD)
+
+    def queries_by_alias(self, method, *args, **kwargs):
+        with CaptureQueriesContext(connections['default']) as primary, \
+                CaptureQueriesContext(connections[self.replica]) as replica:
+            response = method(*args, **kwargs)
+        return response, len(primary), len(replica)
+
+    def test_reads_go_to_replica(self):
+        with override_settings(DATABASE_REPLICAS=[self.replica]):
+            response, primary, replica = self.queries_by_alias(
+                self.client.get, reverse('object_list'), {'key': 'color'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+
+    def test_writes_go_to_primary_and_pin_the_writer(self):
+        with override_settings(DATABASE_REPLICAS=[self.replica]):
+            response, primary, replica = self.queries_by_alias(
+                self.client.post, reverse('body'), dict(PAYLOAD, batch_id='second'),
+                content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            self.assertGreater(primary, 0)
+            self.assertEqual(replica, 0)
+
+            response, primary, replica = self.queries_by_alias(
+                self.client.get, reverse('object_list'), {'key': 'color'})
+        self.assertEqual(len(response.json()), 2)
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
@@ -0,0 +1,187 @@
+"""
+Tests for chunked batch deletion: batch_processing.deletion, the DELETE batch route and the
+prune_batches command.
+"""
+import io
+from datetime import timedelta
+
+from django.contrib.auth.models import User
+from django.core.management import CommandError, call_command
+from django.test import override_settings
+from django.urls import reverse
+from django.utils import timezone
+
+from batch_processing.deletion import delete_batches
+from batch_processing.models import Batch, Batch_Object, Batch_Object_Data_Item, Object_Change_Log
+from batch_processing.tests import BatchProcessingTestCase
+from batch_processing.views import store_batch
+
+
+class Interrupted(Exception):
+    pass
+
+
+def interrupt(label, deleted, total):
+    raise Interrupted()
+
+
+def make_batch(batch_id, objects=3, items=2):
+    return store_batch({
+        'batch_id': batch_id,
+        'objects': [
+            {
+                'object_id': f'{batch_id}-{number}',
+                'data': [{'key': f'key{item}', 'value': f'value{item}'} for item in range(items)],
+            }
+            for number in range(objects)
+        ],
+    })
+
+
+class DeleteBatchesTests(BatchProcessingTestCase):
+
+    def setUp(self):
+        self.batch = make_batch('deleteme')
+        self.kept = make_batch('keepme')
+
+    def assertBatchGone(self, batch):
+        self.assertFalse(Batch.objects.filter(id=batch.id).exists())
+        self.assertFalse(Batch_Object.objects.filter(batch_id=batch.id).exists())
+        self.assertFalse(Batch_Object_Data_Item.objects.filter(object__batch_id=batch.id).exists())
+
+    def assertBatchIntact(self, batch, objects=3, items=2):
+        self.assertTrue(Batch.objects.filter(id=batch.id).exists())
+        self.assertEqual(Batch_Object.objects.filter(batch_id=batch.id).count(), objects)
+        self.assertEqual(
+            Batch_Object_Data_Item.objects.filter(object__batch_id=batch.id).count(),
+            objects * items)
+
+    def deletions_logged(self):
+        return list(Object_Change_Log.objects.filter(
+            action=Object_Change_Log.DELETED).values_list('object_pk', flat=True))
+
+    def test_deletes_batch_objects_and_data_items(self):
+        object_pks = set(Batch_Object.objects.filter(batch=self.batch).values_list('id', flat=True))
+        counts = delete_batches([self.batch.id], chunk_size=2, throttle=0)
+        self.assertEqual(
+            counts, {'batches': 1, 'objects': 3, 'data_items': 6, 'complete': True})
+        self.assertBatchGone(self.batch)
+        self.assertBatchIntact(self.kept)
+        self.assertEqual(sorted(self.deletions_logged()), sorted(object_pks))
+
+    def test_resumes_after_interruption(self):
+        def interrupt_after_first_object_chunk(label, deleted, total):
+            if label == 'objects':
+                raise Interrupted()
+
+        with self.assertRaises(Interrupted):
+            delete_batches([self.batch.id], chunk_size=1, throttle=0,
+                           progress=interrupt_after_first_object_chunk)
+        # The committed chunks stay deleted; the batch row is still there to delete again
+        self.assertTrue(Batch.objects.filter(id=self.batch.id).exists())
+        self.assertEqual(Batch_Object.objects.filter(batch=self.batch).count(), 2)
+
+        counts = delete_batches([self.batch.id], chunk_size=1, throttle=0)
+        self.assertEqual(counts['objects'], 2)
+        self.assertTrue(counts['complete'])
+        self.assertBatchGone(self.batch)
+        # Each object's deletion is logged exactly once across both runs
+        self.assertEqual(len(self.deletions_logged()), 3)
+        self.assertEqual(len(set(self.deletions_logged())), 3)
+
+    def test_time_limit_stops_at_chunk_boundary(self):
+        counts = delete_batches([self.batch.id], chunk_size=1, throttle=0, time_limit=0)
+        self.assertEqual(
+            counts, {'batches': 0, 'objects': 1, 'data_items': 2, 'complete': False})
+        # The objects left behind still have all of their data items
+        self.assertBatchIntact(self.batch, objects=2)
+
+        for _attempt in range(20):
+            if delete_batches([self.batch.id], chunk_size=1, throttle=0, time_limit=0)[
+                    'complete']:
+                break
+        self.assertBatchGone(self.batch)
+        self.assertBatchIntact(self.kept)
+
+    def test_rejects_chunk_size_and_throttle_that_cannot_finish(self):
+        with self.assertRaises(ValueError):
+            delete_batches([self.batch.id], chunk_size=0, throttle=0)
+        with self.assertRaises(ValueError):
+            delete_batches([self.batch.id], chunk_size=1, throttle=-1)
+        self.assertBatchIntact(self.batch)
+
+
+class DeleteBatchRouteTests(BatchProcessingTestCase):
+
+    def setUp(self):
+        self.batch = make_batch('deleteme')
+        self.url = reverse('batch', kwargs={'batch_id': 'deleteme'})
+
+    def test_requires_admin(self):
+        self.assertEqual(self.client.delete(self.url).status_code, 403)
+        self.client.force_login(User.objects.create_user('someone', 'someone@example.com'))
+        self.assertEqual(self.client.delete(self.url).status_code, 403)
+        self.assertTrue(Batch.objects.filter(id=self.batch.id).exists())
+
+    def test_admin_deletes(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com'))
+        response = self.client.delete(self.url)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['objects'], 3)
+        self.assertFalse(Batch.objects.filter(id=self.batch.id).exists())
+        self.assertEqual(self.client.delete(self.url).status_code, 404)
+
+    @override_settings(BATCH_DELETE_CHUNK_SIZE=1, BATCH_DELETE_THROTTLE_SECONDS=0,
+                       BATCH_DELETE_REQUEST_SECONDS=0)
+    def test_incomplete_delete_answers_202_until_done(self):
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com'))
+        response = self.client.delete(self.url)
+        self.assertEqual(response.status_code, 202)
+        self.assertFalse(response.json()['complete'])
+        for _attempt in range(20):
+            response = self.client.delete(self.url)
+            if response.status_code != 202:
+                break
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Batch.objects.filter(id=self.batch.id).exists())
+
+
+class PruneBatchesTests(BatchProcessingTestCase):
+
+    def setUp(self):
+        self.old = make_batch('old')
+        self.new = make_batch('new')
+        Batch.objects.filter(id=self.old.id).update(created=timezone.now() - timedelta(days=40))
+
+    def prune(self, **options):
+        out = io.StringIO()
+        call_command('prune_batches', stdout=out, throttle=0, **options)
+        return out.getvalue()
+
+    def test_dry_run_deletes_nothing(self):
+        output = self.prune(days=30, dry_run=True)
+        self.assertIn('1 batch(es)', output)
+        self.assertEqual(Batch.objects.count(), 2)
+        self.assertEqual(Batch_Object.objects.count(), 6)
+
+    def test_prunes_only_old_batches(self):
+        output = self.prune(days=30, chunk_size=2)
+        self.assertIn('Deleted 1 batch(es), 3 object(s), 6 data item(s)', output)
+        self.assertFalse(Batch.objects.filter(id=self.old.id).exists())
+        self.assertEqual(Batch_Object.objects.filter(batch=self.new).count(), 3)
+
+    def test_rerun_finishes_interrupted_prune(self):
+        with self.assertRaises(Interrupted):
+            delete_batches([self.old.id], chunk_size=1, throttle=0,
+                           progress=interrupt)
+        output = self.prune(days=30, chunk_size=1)
+        self.assertIn('Deleted 1 batch(es)', output)
+        self.assertFalse(Batch.objects.filter(id=self.old.id).exists())
+        self.assertFalse(Batch_Object_Data_Item.objects.filter(object__batch=self.old).exists())
+        self.assertEqual(Batch_Object.objects.filter(batch=self.new).count(), 3)
+
+    def test_rejects_bad_chunk_size_and_throttle(self):
+        for options in ({'chunk_size': 0}, {'chunk_size': -5}, {'throttle': -1}):
+            with self.subTest(**options), self.assertRaises(CommandError):
+                call_command('prune_batches', days=30, **options)
+        self.assertEqual(Batch.objects.count(), 2)
@@ -0,0 +1,125 @@
+"""
+Tests for the in-memory object index (batch_processing.object_index) and the object_list
+route answering from it.
+
+The index normally builds in a background thread, on a connection of its own that cannot see
+data a TestCase has not committed.  These tests build it in the test thread instead and put
+it in place of the shared one.
+"""
+from unittest import mock
+
+from django.core.cache import cache
+from django.test import override_settings
+from django.urls import reverse
+
+from batch_processing import db_routing, object_index
+from batch_processing.deletion import delete_batches
+from batch_processing.models import Batch_Object
+from batch_processing.object_index import ObjectIndex, get_object_index
+from batch_processing.tests import BatchProcessingTestCase
+from batch_processing.views import store_batch
+
+
+def make_object(object_id, **data):
+    return {'object_id': object_id,
+            'data': [{'key': key, 'value': value} for key, value in data.items()]}
+
+
+class ObjectIndexTests(BatchProcessingTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.first = store_batch({'batch_id': 'first', 'objects': [
+            make_object('red-shoe', color='red', type='shoe'),
+            make_object('blue-shoe', color='blue', type='shoe'),
+            make_object('red-hat', color='red', type='hat', size='large'),
+        ]})
+
+    def setUp(self):
+        self.index = ObjectIndex()
+        self.index.build()
+
+    def identifiers(self, object_pks):
+        return sorted(Batch_Object.objects.filter(id__in=object_pks)
+                      .values_list('object_identifier', flat=True))
+
+    def select(self, **terms):
+        return self.identifiers(self.index.select(**terms))
+
+    def test_select_combines_terms(self):
+        self.assertEqual(self.select(all_of=[('color', 'red'), ('type', 'shoe')]), ['red-shoe'])
+        self.assertEqual(self.select(any_of=[('type', 'hat'), ('color', 'blue')]),
+                         ['blue-shoe', 'red-hat'])
+        self.assertEqual(self.select(all_of=[('type', 'shoe')], none_of=[('color', 'red')]),
+                         ['blue-shoe'])
+        # A term with only a key (or only a value) matches any value (or key)
+        self.assertEqual(self.select(all_of=[('size', None)]), ['red-hat'])
+        self.assertEqual(self.select(all_of=[(None, 'red')], none_of=[(None, 'hat')]),
+                         ['red-shoe'])
+        self.assertEqual(
+            self.select(all_of=[('color', 'red')], any_of=[('type', 'shoe'), ('size', 'large')],
+                        none_of=[('type', 'hat')]),
+            ['red-shoe'])
+        self.assertEqual(self.select(all_of=[('color', 'green')]), [])
+
+    def test_sync_replays_creations_and_deletions(self):
+        store_batch({'batch_id': 'second', 'objects': [
+            make_object('green-shoe', color='green', type='shoe')]})
+        delete_batches([self.first.id], throttle=0)
+        self.assertTrue(self.index.sync(force=True))
+        self.assertEqual(self.select(all_of=[('type', 'shoe')]), ['green-shoe'])
+        self.assertEqual(self.select(all_of=[('color', 'red')]), [])
+        self.assertEqual(len(self.index.select()), 1)
+
+    @override_settings(OBJECT_INDEX_ENABLED=True, OBJECT_INDEX_SYNC_SECONDS=0,
+                       OBJECT_INDEX_MAX_LAG=1)
+    def test_falls_back_to_sql_when_too_far_behind(self):
+        with mock.patch.object(object_index, '_index', self.index):
+            self.assertIs(get_object_index(), self.index)
+            store_batch({'batch_id': 'second', 'objects': [
+                make_object('green-shoe', color='green', type='shoe'),
+                make_object('green-hat', color='green', type='hat'),
+            ]})
+            self.assertIsNone(get_object_index())
+            response = self.client.get(reverse('object_list'), {'key': 'color', 'value': 'green'})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sorted(entry['object_id'] for entry in response.json()),
+                         ['green-hat', 'green-shoe'])
+
+    @override_settings(OBJECT_INDEX_ENABLED=True, OBJECT_INDEX_SYNC_SECONDS=0)
+    def test_list_matches_sql(self):
+        queries = [{}, {'key': 'color'}, {'value': 'shoe'}, {'key': 'color', 'value': 'red'},
+                   {'key': 'color', 'value': 'green'}]
+        for params in queries:
+            with self.subTest(params=params):
+                with override_settings(OBJECT_INDEX_ENABLED=False):
+                    from_sql = self.client.get(reverse('object_list'), params)
+                with mock.patch.object(object_index, '_index', self.index), \
+                        mock.patch.object(ObjectIndex, 'serialize',
+                                          autospec=True, side_effect=ObjectIndex.serialize) \
+                        as serialize:
+                    from_index = self.client.get(reverse('object_list'), params)
+                self.assertTrue(serialize.called)
+                self.assertEqual(from_index.status_code, from_sql.status_code)
+                self.assertEqual(from_index.json(), from_sql.json())
+                self.assertEqual(from_index['ETag'], from_sql['ETag'])
+
+    @override_settings(OBJECT_INDEX_ENABLED=True, DATABASE_REPLICAS=['default'])
+    def test_pinned_client_bypasses_index(self):
+        cache.clear()
+        self.addCleanup(cache.clear)
+        payload = {'batch_id': 'second', 'objects': [make_object('green-shoe', color='green')]}
+        with mock.patch.object(object_index, '_index', self.index), \
+                mock.patch.object(db_routing, 'choose_replica', return_value='default'), \
+                mock.patch.object(ObjectIndex, 'select', autospec=True,
+                                  side_effect=ObjectIndex.select) as select:
+            self.client.get(reverse('object_list'), {'key': 'color', 'value': 'red'})
+            self.assertTrue(select.called)
+            select.reset_mock()
+
+            response = self.client.post(reverse('body'), payload, content_type='application/json')
+            self.assertEqual(response.status_code, 200)
+            # The writer reads its own write, even though the index has not synced it yet
+            response = self.client.get(reverse('object_list'), {'key': 'color', 'value': 'green'})
+            self.assertFalse(select.called)
+        self.assertEqual([entry['object_id'] for entry in response.json()], ['green-shoe'])
@@ -0,0 +1,68 @@
+"""
+Tests for on-demand request profiling (batch_processing.profiling) and the profiles/ routes.
+"""
+import tempfile
+
+from django.contrib.auth.models import User
+from django.test import override_settings
+from django.urls import reverse
+
+from batch_processing.profiling import list_report_names, load_report
+from batch_processing.tests import BatchProcessingTestCase
+
+
+@override_settings(PROFILING_TOKEN='letmein', PROFILING_MAX_REPORTS=100)
+class ProfilingTests(BatchProcessingTestCase):
+
+    def setUp(self):
+        profiling_dir = tempfile.TemporaryDirectory()
+        self.addCleanup(profiling_dir.cleanup)
+        directory = override_settings(PROFILING_DIR=profiling_dir.name)
+        directory.enable()
+        self.addCleanup(directory.disable)
+
+    def request(self, **headers):
+        response = self.client.get(reverse('changes'), **headers)
+        self.assertEqual(response.status_code, 200)
+        return response
+
+    def test_token_header_triggers_report(self):
+        name = self.request(HTTP_X_PROFILE='letmein')['X-Profile-Report']
+        self.assertEqual(list_report_names(), [name])
+        report = load_report(name)
+        self.assertEqual((report['trigger'], report['path']), ('header', reverse('changes')))
+        self.assertTrue(report['queries'])
+
+    def test_wrong_token_gives_no_report(self):
+        for token in ('letmeout', 'letmein ', 'létmein', '☃'):
+            with self.subTest(token=token):
+                response = self.request(HTTP_X_PROFILE=token)
+                self.assertFalse(response.has_header('X-Profile-Report'))
+        self.assertEqual(list_report_names(), [])
+
+    @override_settings(PROFILING_SAMPLE_RATE=1)
+    def test_sampled_requests_are_reported(self):
+        response = self.request()
+        # Only requests that asked for a report are told its name
+        self.assertFalse(response.has_header('X-Profile-Report'))
+        names = list_report_names()
+        self.assertEqual(len(names), 1)
+        self.assertEqual(load_report(names[0])['trigger'], 'sample')
+
+    @override_settings(PROFILING_MAX_REPORTS=2)
+    def test_keeps_newest_reports(self):
+        names = [self.request(HTTP_X_PROFILE='letmein')['X-Profile-Report']
+                 for _attempt in range(4)]
+        self.assertEqual(list_report_names(), [names[3], names[2]])
+
+    def test_reports_are_for_admins_only(self):
+        name = self.request(HTTP_X_PROFILE='letmein')['X-Profile-Report']
+        urls = [reverse('profiles'), reverse('profile', kwargs={'name': name})]
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_user('someone', 'someone@example.com'))
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 403)
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com'))
+        for url in urls:
+            self.assertEqual(self.client.get(url).status_code, 200)
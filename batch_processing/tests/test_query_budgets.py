@@ -0,0 +1,242 @@
+"""
+Query-count and query-plan regression tests for every route in batch_processing/urls.py.
+
+Performance regressions here nearly always come from query shape, so:
+
+ - every route is driven against the samples in files/, and the number of SQL statements it
+   issues must stay within its "fixed" budget in query_budgets.json.  No route may grow with
+   the number of objects: ingest bulk-inserts all of a batch's objects, then all of their
+   data items, and retrieval loads all objects and items in one query each.  object_list
+   pattern searches (value__startswith, value__contains) have their own budget,
+   object_list_search, for the statement timeout they set.  Budgets are the measured counts on PostgreSQL.  Lower one when
+   a change improves a route; raising one needs a reason in the commit message.
+ - on PostgreSQL, the object_list filter queries are EXPLAINed with sequential scans disabled.
+   If the plan still scans Batch_Object_Data_Item sequentially, no index can serve the query.
+
+Run with `python manage.py test batch_processing`.
+"""
+import io
+import json
+import os
+import tempfile
+from contextlib import ExitStack
+
+from django.contrib.auth.models import User
+from django.db import connection, connections
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+from assessment.settings import BASE_DIR
+from batch_processing import urls
+from batch_processing.models import Batch_Object, Batch_Object_Data_Item
+from batch_processing.tests import BatchProcessingTestCase
+
+BUDGETS_PATH = os.path.join(os.path.dirname(__file__), 'query_budgets.json')
+SAMPLES_DIR = os.path.join(BASE_DIR, 'files')
+
+# Samples the body route should refuse as not conforming to the schema: one of the objects
+# in this sample has no "data".
+EXPECTED_INVALID_SAMPLES = {'995c3f51ebd7486695d8947152bb38d3.json'}
+
+# object_list filters whose plans must not fall back to a sequential scan of the data items
+FILTER_QUERIES = [
+    {'key': 'color'},
+    {'value': 'gold'},
+    {'key': 'color', 'value': 'gold'},
+    {'key': 'country', 'value__startswith': 'Z'},
+    {'value__contains': 'old'},
+]
+# Every object_list query with a budget: the filters, plus the unfiltered list
+LIST_QUERIES = [{}] + FILTER_QUERIES
+
+
+def load_sample(file_name):
+    with open(os.path.join(SAMPLES_DIR, file_name)) as sample_file:
+        return json.load(sample_file)
+
+
+class CaptureAllQueries(ExitStack):
+    """
+    Captures queries on every database, so reads routed to replicas are counted too.
+    """
+
+    def __enter__(self):
+        super().__enter__()
+        self.contexts = [
+            self.enter_context(CaptureQueriesContext(connections[alias])) for alias in connections
+        ]
+        return self
+
+    @property
+    def captured_queries(self):
+        return [query for context in self.contexts for query in context.captured_queries]
+
+    def __len__(self):
+        return len(self.captured_queries)
+
+
+class QueryBudgetTests(BatchProcessingTestCase):
+    databases = '__all__'
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.sample_status = {}
+        for file_name in sorted(os.listdir(SAMPLES_DIR)):
+            if not file_name.endswith('.json') or file_name == 'schema.json':
+                continue
+            response = cls.client_class().post(
+                reverse('body'), load_sample(file_name), content_type='application/json')
+            cls.sample_status[file_name] = response.status_code
+        cls.admin = User.objects.create_superuser('budget-admin', 'admin@example.com', 'unused')
+        if connection.vendor == 'postgresql':
+            # Plan with statistics for the loaded samples, as production would, rather than
+            # whatever the planner makes of never-analyzed tables
+            with connection.cursor() as cursor:
+                for model in (Batch_Object, Batch_Object_Data_Item):
+                    cursor.execute(f'ANALYZE {connection.ops.quote_name(model._meta.db_table)}')
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        with open(BUDGETS_PATH) as budgets_file:
+            cls.budgets = json.load(budgets_file)
+
+    def assertWithinBudget(self, url_name, queries):
+        allowed = self.budgets[url_name]['fixed']
+        self.assertLessEqual(
+            len(queries), allowed,
+            f'{url_name} issued {len(queries)} queries; budget is {allowed}:\n'
+            + '\n'.join(query['sql'] for query in queries.captured_queries)
+        )
+
+    def unique_object_id(self):
+        # Some samples share object IDs; the object route needs one that is unique
+        for object_identifier in Batch_Object.objects.values_list('object_identifier', flat=True):
+            if Batch_Object.objects.filter(object_identifier=object_identifier).count() == 1:
+                return object_identifier
+        self.fail('No sample object has a unique object ID')
+
+    def test_samples_loaded(self):
+        for file_name, status_code in self.sample_status.items():
+            with self.subTest(sample=file_name):
+                if file_name in EXPECTED_INVALID_SAMPLES:
+                    self.assertEqual(status_code, 400)
+                else:
+                    self.assertEqual(status_code, 200)
+        self.assertTrue(Batch_Object_Data_Item.objects.exists())
+
+    def test_every_route_has_a_budget(self):
+        for pattern in urls.urlpatterns:
+            self.assertIn(pattern.name, self.budgets, f'Route {pattern.name} has no query budget')
+
+    def test_body(self):
+        payload = load_sample('a3e3853750724e2994515bb70d646c32.json')
+        with CaptureAllQueries() as queries:
+            response = self.client.post(reverse('body'), payload, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinBudget('body', queries)
+
+    def test_file(self):
+        file_name = '7447156584c543658455558747c64d2c.json'
+        with open(os.path.join(SAMPLES_DIR, file_name), 'rb') as sample_file:
+            upload = io.BytesIO(sample_file.read())
+        upload.name = file_name
+        with CaptureAllQueries() as queries:
+            response = self.client.post(reverse('file'), {'json_doc': upload})
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinBudget('file', queries)
+
+    def test_object(self):
+        url = reverse('object', kwargs={'object_id': self.unique_object_id()})
+        with CaptureAllQueries() as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinBudget('object', queries)
+
+        with CaptureAllQueries() as queries:
+            response = self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'])
+        self.assertEqual(response.status_code, 304)
+        self.assertWithinBudget('object', queries)
+
+    def test_object_list(self):
+        for params in LIST_QUERIES:
+            with self.subTest(params=params):
+                with CaptureAllQueries() as queries:
+                    response = self.client.get(reverse('object_list'), params)
+                self.assertEqual(response.status_code, 200)
+                self.assertTrue(response.json())
+                search = 'value__startswith' in params or 'value__contains' in params
+                self.assertWithinBudget(
+                    'object_list_search' if search else 'object_list', queries)
+
+                with CaptureAllQueries() as queries:
+                    response = self.client.get(reverse('object_list'), params,
+                                               HTTP_IF_NONE_MATCH=response['ETag'])
+                self.assertEqual(response.status_code, 304)
+                self.assertWithinBudget(
+                    'object_list_search' if search else 'object_list', queries)
+
+    def test_batch(self):
+        payload = dict(load_sample('test-good.json'), batch_id='querybudgetdelete')
+        self.client.post(reverse('body'), payload, content_type='application/json')
+        self.client.force_login(self.admin)
+        with CaptureAllQueries() as queries:
+            response = self.client.delete(reverse('batch', kwargs={'batch_id': 'querybudgetdelete'}))
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinBudget('batch', queries)
+
+    def test_changes(self):
+        with CaptureAllQueries() as queries:
+            response = self.client.get(reverse('changes'), {'limit': 200})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.json()['changes'])
+        self.assertWithinBudget('changes', queries)
+
+    def test_admission(self):
+        self.client.force_login(self.admin)
+        with CaptureAllQueries() as queries:
+            response = self.client.get(reverse('admission'))
+        self.assertEqual(response.status_code, 200)
+        self.assertWithinBudget('admission', queries)
+
+    def test_profiles(self):
+        self.client.force_login(self.admin)
+        with tempfile.TemporaryDirectory() as profiling_dir, \
+                override_settings(PROFILING_TOKEN='budget', PROFILING_DIR=profiling_dir):
+            name = self.client.get(reverse('admission'), HTTP_X_PROFILE='budget')[
+                'X-Profile-Report']
+            with CaptureAllQueries() as queries:
+                response = self.client.get(reverse('profiles'))
+            self.assertEqual(response.status_code, 200)
+            self.assertWithinBudget('profiles', queries)
+
+            with CaptureAllQueries() as queries:
+                response = self.client.get(reverse('profile', kwargs={'name': name}))
+            self.assertEqual(response.status_code, 200)
+            self.assertWithinBudget('profile', queries)
+
+    def test_filter_plans_use_indexes(self):
+        if connection.vendor != 'postgresql':
+            self.skipTest('Query plans are only checked on PostgreSQL')
+        data_item_table = Batch_Object_Data_Item._meta.db_table
+        for params in FILTER_QUERIES:
+            with self.subTest(params=params):
+                with CaptureAllQueries() as queries:
+                    self.client.get(reverse('object_list'), params)
+                statements = [
+                    query['sql'] for query in queries.captured_queries
+                    if query['sql'].startswith('SELECT') and data_item_table in query['sql']
+                ]
+                self.assertTrue(statements)
+                with connection.cursor() as cursor:
+                    # With sequential scans priced out, one can only remain if no index applies
+                    cursor.execute('SET enable_seqscan = off')
+                    try:
+                        for sql in statements:
+                            cursor.execute(f'EXPLAIN {sql}')
+                            plan = '\n'.join(row[0] for row in cursor.fetchall())
+                            self.assertNotIn(f'Seq Scan on {data_item_table}', plan,
+                                             f'{sql}\n{plan}')
+                    finally:
+                        cursor.execute('RESET enable_seqscan')
@@ -0,0 +1,61 @@
+"""
+Tests for object_list value pattern searches (value__startswith, value__contains).
+"""
+from unittest import mock
+
+from django.db import OperationalError
+from django.test import override_settings
+from django.urls import reverse
+
+from batch_processing import views
+from batch_processing.tests import BatchProcessingTestCase
+from batch_processing.views import store_batch
+
+
+class ValueSearchTests(BatchProcessingTestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        store_batch({'batch_id': 'search', 'objects': [
+            {'object_id': f'x{number}', 'data': [{'key': 'color', 'value': f'golden{number}'}]}
+            for number in range(3)
+        ]})
+
+    def search(self, **params):
+        return self.client.get(reverse('object_list'), params)
+
+    def test_finds_by_prefix_and_fragment(self):
+        for params in ({'value__startswith': 'gold'}, {'key': 'color', 'value__contains': 'lden'}):
+            with self.subTest(params=params):
+                response = self.search(**params)
+                self.assertEqual(response.status_code, 200)
+                self.assertEqual(len(response.json()), 3)
+                self.assertFalse(response.has_header('X-Result-Truncated'))
+
+    def test_only_one_value_parameter(self):
+        for params in ({'value': 'golden0', 'value__startswith': 'gold'},
+                       {'value__startswith': 'gold', 'value__contains': 'old'},
+                       {'value': 'golden0', 'value__contains': 'old'}):
+            with self.subTest(params=params):
+                response = self.search(**params)
+                self.assertEqual(response.status_code, 400)
+                self.assertIn('Use only one of value', response.json())
+
+    def test_short_fragment_rejected(self):
+        response = self.search(value__contains='ol')
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), 'value__contains needs at least 3 characters.')
+
+    @override_settings(OBJECT_LIST_SEARCH_LIMIT=1)
+    def test_truncated_result_is_flagged(self):
+        response = self.search(value__startswith='gold')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(response.json()), 1)
+        self.assertEqual(response['X-Result-Truncated'], 'true')
+
+    def test_timeout_is_a_bad_request(self):
+        timeout = OperationalError('canceling statement due to statement timeout')
+        with mock.patch.object(views, 'run_bounded_search', side_effect=timeout):
+            response = self.search(value__contains='old')
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('took too long', response.json())
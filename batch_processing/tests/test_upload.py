@@ -0,0 +1,27 @@
+"""
+Tests for batch upload validation.
+"""
+from django.urls import reverse
+
+from batch_processing.models import Batch
+from batch_processing.tests import BatchProcessingTestCase
+
+
+class UploadValidationTests(BatchProcessingTestCase):
+
+    def upload(self, objects):
+        return self.client.post(reverse('body'), {'batch_id': 'invalid', 'objects': objects},
+                                content_type='application/json')
+
+    def test_every_object_and_item_is_validated(self):
+        good = {'object_id': 'good', 'data': [{'key': 'color', 'value': 'gold'}]}
+        for bad in ({'object_id': 'no-data'},
+                    {'data': [{'key': 'color', 'value': 'gold'}]},
+                    {'object_id': 'no-key', 'data': [{'value': 'gold'}]},
+                    {'object_id': 'no-value', 'data': [{'key': 'color', 'value': 'gold'},
+                                                       {'key': 'size'}]}):
+            with self.subTest(bad=bad):
+                response = self.upload([good, bad])
+                self.assertEqual(response.status_code, 400)
+                self.assertEqual(response.json(), 'JSON data does not conform to schema.')
+        self.assertFalse(Batch.objects.exists())
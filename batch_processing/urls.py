@@ -4,12 +4,20 @@
 """
 from django.contrib import admin
 from django.urls import path, re_path
-from batch_processing.views import Upload_Batch_File, Upload_Batch_Body, RetrieveObject, RetrieveObjectArray
+from batch_processing.views import Upload_Batch_File, Upload_Batch_Body, RetrieveObject, RetrieveObjectArray, \
+    DeleteBatch, RetrieveChanges, RetrieveAdmissionStats, RetrieveProfileReportList, \
+    RetrieveProfileReport
 
 urlpatterns = [
     path('file/', Upload_Batch_File.as_view(), name="file"),
     path('body/', Upload_Batch_Body.as_view(), name="body"),
     re_path(r'^object/(?P<object_id>[a-zA-Z0-9]*)/$', RetrieveObject.as_view(), name="object"),
     path('object_list/', RetrieveObjectArray.as_view(), name="object_list"),
+    re_path(r'^batch/(?P<batch_id>[a-zA-Z0-9]*)/$', DeleteBatch.as_view(), name="batch"),
+    path('changes/', RetrieveChanges.as_view(), name="changes"),
+    path('admission/', RetrieveAdmissionStats.as_view(), name="admission"),
+    path('profiles/', RetrieveProfileReportList.as_view(), name="profiles"),
+    re_path(r'^profiles/(?P<name>[0-9T]+-[0-9a-f]+)/$', RetrieveProfileReport.as_view(),
+            name="profile"),
 
 ]
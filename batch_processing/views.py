@@ -6,6 +6,7 @@ Batch processing module
 import logging
 import os
 from django.conf import settings
+from django.db import OperationalError, connections, router, transaction
 from django.shortcuts import render
 
 from rest_framework.views import APIView
@@ -13,6 +14,7 @@ from rest_framework.response import Response
 import rest_framework.status as status
 from rest_framework.exceptions import ParseError
 from rest_framework.parsers import JSONParser
+from rest_framework.permissions import IsAdminUser
 
 # In case we decide to ever do a translation, it is easy enough to mark all our strings now.
 # It is a pain to do it later
@@ -20,8 +22,15 @@ from django.utils.translation import gettext_lazy as _
 
 from assessment.settings import BASE_DIR
 import assessment.settings
+from batch_processing.admission import admission_controller
+from batch_processing.conditional import apply_cache_headers, collection_etag, content_hash, \
+    etag_matches, object_etag
+from batch_processing.db_routing import ReplicaReadMixin, is_pinned_to_primary, pin_to_primary
+from batch_processing.deletion import delete_batches
 from batch_processing.forms import Json_Doc_Upload_Form
-from batch_processing.models import Batch_Object, Batch_Object_Data_Item, Batch
+from batch_processing.models import Batch_Object, Batch_Object_Data_Item, Batch, Object_Change_Log
+from batch_processing.object_index import get_object_index
+from batch_processing.profiling import list_report_names, load_report
 import json
 import jsonschema
 from rest_framework.negotiation import BaseContentNegotiation
@@ -68,9 +77,76 @@ def validate_json_against_schema(json_data):
         raise InternalServerError(e)
     try:
         jsonschema.validate(json_data, schema_dict)
-    except ValueError as error:
+    except (jsonschema.ValidationError, ValueError) as error:
+        logger.debug(f'JSON does not conform to schema: {error}')
         raise ClientRequestError(_('JSON does not conform to schema.'))
 
+def store_batch(batch_dict):
+    """
+    Persist a batch dictionary that has already been validated against the schema.
+    Every new object is recorded in the Object_Change_Log, which the in-memory object index
+    (batch_processing.object_index) replays to stay current.
+
+    :param batch_dict:
+    :return: the saved Batch
+    """
+    with transaction.atomic():
+        batch = Batch(batch_identifier=batch_dict['batch_id'])
+        batch.save()
+        logger.debug(f'Created batch {batch}')
+        elements = batch_dict['objects']
+        batch_objects = [
+            Batch_Object(
+                object_identifier=element['object_id'],
+                batch=batch,
+                content_hash=content_hash((item['key'], item['value']) for item in element['data']),
+            )
+            for element in elements
+        ]
+        # The data items need their objects' primary keys, which only some backends hand back
+        # from a bulk INSERT (PostgreSQL does)
+        if connections[router.db_for_write(Batch_Object)].features.can_return_rows_from_bulk_insert:
+            Batch_Object.objects.bulk_create(batch_objects)
+        else:
+            for batch_object in batch_objects:
+                batch_object.save()
+        logger.debug(f'Created {len(batch_objects)} batch objects for {batch}')
+        Batch_Object_Data_Item.objects.bulk_create([
+            Batch_Object_Data_Item(key=item['key'], value=item['value'], object=batch_object)
+            for batch_object, element in zip(batch_objects, elements)
+            for item in element['data']
+        ])
+        changes = [
+            Object_Change_Log(object_pk=batch_object.id,
+                              object_identifier=batch_object.object_identifier,
+                              batch_identifier=batch.batch_identifier,
+                              action=Object_Change_Log.CREATED)
+            for batch_object in batch_objects
+        ]
+        # Written last, so the sequence lock is held only for the moment before commit
+        Object_Change_Log.lock_sequence()
+        Object_Change_Log.objects.bulk_create(changes)
+    return batch
+
+def run_bounded_search(data_objects):
+    """
+    Evaluate a value pattern search with a cap on matches and a statement timeout,
+    so a pathological pattern cannot run away with the database.
+
+    :param data_objects: Batch_Object_Data_Item queryset using a pattern lookup
+    :return: (queryset of at most settings.OBJECT_LIST_SEARCH_LIMIT data items,
+        whether more matched)
+    """
+    limit = getattr(settings, 'OBJECT_LIST_SEARCH_LIMIT', 1000)
+    timeout_ms = int(getattr(settings, 'OBJECT_LIST_SEARCH_TIMEOUT_MS', 2000))
+    connection = connections[data_objects.db]
+    with transaction.atomic(using=data_objects.db):
+        if connection.vendor == 'postgresql':
+            with connection.cursor() as cursor:
+                cursor.execute(f'SET LOCAL statement_timeout = {timeout_ms}')
+        item_ids = list(data_objects.values_list('id', flat=True)[:limit + 1])
+    return Batch_Object_Data_Item.objects.filter(id__in=item_ids[:limit]), len(item_ids) > limit
+
 class IgnoreClientContentNegotiation(BaseContentNegotiation):
     def select_parser(self, request, parsers):
         """
@@ -212,22 +288,8 @@ class Upload_Batch_File(APIView):
         # DO STUFF
         # We have a dictionary. It should conform to schema.  Populate objects
         try:
-            batch = Batch(batch_identifier=batch_dict['batch_id'])
-            logger.debug(f'Created batch {batch}')
-            batch.save()
-            batch_objects = []
-            for element in batch_dict['objects']:
-                batch_object = Batch_Object(object_identifier=element['object_id'], batch=batch)
-                logger.debug(f'Created batch_object {batch_object}')
-                batch_object.save()
-                batch_objects.append(batch_object)
-                data_objects = []
-                for item in element['data']:
-                    data_object = Batch_Object_Data_Item(key=item['key'], value=item['value'],
-                                                         object=batch_object)
-                    logger.debug(f'Created data_object {data_object}')
-                    data_object.save()
-                    data_objects.append(data_object)
+            store_batch(batch_dict)
+            pin_to_primary(request)
             return Response(status.HTTP_200_OK)
         except Exception as e:
             logger.error(f'Unexpected problem assembling JSON return: {e}')
@@ -341,21 +403,8 @@ class Upload_Batch_Body(APIView):
             )
 	    # We have a dictionary. It should conform to schema.  Populate objects
         try:
-            batch = Batch(batch_identifier = batch_dict['batch_id'])
-            logger.debug(f'Created batch {batch}')
-            batch.save()
-            batch_objects = []
-            for element in batch_dict['objects']:
-                batch_object = Batch_Object(object_identifier = element['object_id'], batch = batch)
-                logger.debug(f'Created batch_object {batch_object}')
-                batch_object.save()
-                batch_objects.append(batch_object)
-                data_objects = []
-                for item in element['data']:
-                    data_object = Batch_Object_Data_Item(key = item['key'], value = item['value'], object = batch_object)
-                    logger.debug(f'Created data_object {data_object}')
-                    data_object.save()
-                    data_objects.append(data_object)
+            store_batch(batch_dict)
+            pin_to_primary(request)
             return Response(status.HTTP_200_OK)
         except Exception as e:
             logger.error(f'Unexpected problem assembling JSON return: {e}')
@@ -365,7 +414,7 @@ class Upload_Batch_Body(APIView):
             )
 
 
-class RetrieveObject(APIView):
+class RetrieveObject(ReplicaReadMixin, APIView):
     """
     Retrieves an object by object ID
     """
@@ -378,6 +427,17 @@ class RetrieveObject(APIView):
                 status.HTTP_400_BAD_REQUEST
             )
         logger.debug(f'Got object id {object_id}')
+        if request.META.get('HTTP_IF_NONE_MATCH'):
+            # Answer revalidation from the object row alone, without touching its data items
+            content_hashes = list(
+                Batch_Object.objects.filter(object_identifier__exact=object_id).values_list(
+                    'content_hash', flat=True)[:2]
+            )
+            if len(content_hashes) == 1 and etag_matches(request, object_etag(content_hashes[0])):
+                return apply_cache_headers(
+                    request, Response(status=status.HTTP_304_NOT_MODIFIED),
+                    object_etag(content_hashes[0])
+                )
         batch_object = None
         try:
             batch_object = Batch_Object.objects.get(object_identifier__exact=object_id)
@@ -410,7 +470,10 @@ class RetrieveObject(APIView):
                 dict_item['key'] = batch_object_data_item.key
                 dict_item['value'] = batch_object_data_item.value
                 batch_object_dict['data'].append(dict_item)
-            return Response(batch_object_dict,status.HTTP_200_OK )
+            return apply_cache_headers(
+                request, Response(batch_object_dict,status.HTTP_200_OK ),
+                object_etag(batch_object.content_hash)
+            )
         except Exception as e:
             logger.error(f'Unexpected problem assembling JSON return: {e}')
             return Response(
@@ -419,7 +482,7 @@ class RetrieveObject(APIView):
             )
 
 
-class RetrieveObjectArray(APIView):
+class RetrieveObjectArray(ReplicaReadMixin, APIView):
     """
     Retrieves an array of objects by key or value.
     The easiest way is to use query parameters on a GET method, but that is a problematic approach
@@ -438,7 +501,42 @@ class RetrieveObjectArray(APIView):
 
         key = request.GET.get("key", None)
         value = request.GET.get("value", None)
-        logger.debug(f'Got key {key} and value {value}')
+        value_prefix = request.GET.get("value__startswith", None)
+        value_fragment = request.GET.get("value__contains", None)
+        logger.debug(f'Got key {key} and value {value}, prefix {value_prefix}, '
+                     f'fragment {value_fragment}')
+
+        if len([v for v in (value, value_prefix, value_fragment) if v]) > 1:
+            return Response(
+                _("Use only one of value, value__startswith and value__contains."),
+                status.HTTP_400_BAD_REQUEST
+            )
+        min_fragment = getattr(settings, 'OBJECT_LIST_CONTAINS_MIN_LENGTH', 3)
+        if value_fragment and len(value_fragment) < min_fragment:
+            # The trigram index cannot help with anything shorter
+            return Response(
+                _("value__contains needs at least %(length)d characters.") % {
+                    'length': min_fragment},
+                status.HTTP_400_BAD_REQUEST
+            )
+
+        # Exact matches can be answered from the in-memory index when it is enabled and current.
+        # A client that has just written reads from the primary instead, since the index may not
+        # have replayed its write yet.
+        object_index = None
+        if not (value_prefix or value_fragment or is_pinned_to_primary(request)):
+            object_index = get_object_index()
+        if object_index is not None:
+            try:
+                object_pks = object_index.select(all_of=[(key or None, value or None)])
+                etag = object_index.etag(object_pks)
+                if etag_matches(request, etag):
+                    return apply_cache_headers(
+                        request, Response(status=status.HTTP_304_NOT_MODIFIED), etag)
+                return apply_cache_headers(
+                    request, Response(object_index.serialize(object_pks), status.HTTP_200_OK), etag)
+            except Exception as e:
+                logger.error(f'Unexpected problem reading object index, falling back to SQL: {e}')
 
         data_objects = None
         try:
@@ -451,6 +549,10 @@ class RetrieveObjectArray(APIView):
                 data_objects = Batch_Object_Data_Item.objects.filter(value=value)
             else:
                 data_objects = Batch_Object_Data_Item.objects.all()
+            if (value_prefix):
+                data_objects = data_objects.filter(value__startswith=value_prefix)
+            elif (value_fragment):
+                data_objects = data_objects.filter(value__contains=value_fragment)
 
         except Batch_Object_Data_Item.DoesNotExist:
             logger.error(f'Failed to find object with ID {object_id}')
@@ -458,52 +560,241 @@ class RetrieveObjectArray(APIView):
                 _("The request object was not found in the database."),
                 status.HTTP_404_NOT_FOUND
             )
-        batch_objects=set()
+        truncated = False
+        if (value_prefix or value_fragment):
+            try:
+                data_objects, truncated = run_bounded_search(data_objects)
+            except OperationalError as e:
+                logger.error(f'Value search for prefix {value_prefix} fragment {value_fragment} '
+                             f'failed: {e}')
+                return Response(
+                    _("The value search took too long. Use a more specific pattern."),
+                    status.HTTP_400_BAD_REQUEST
+                )
+
+        # The matching objects' keys and hashes give the collection ETag, and then drive the
+        # response, so the whole list costs two queries however many objects match
+        batch_objects = None
         try:
-            for data_object in data_objects:
-                batch_objects.add(data_object.object)
+            batch_objects = list(
+                Batch_Object.objects.filter(id__in=data_objects.values('object_id')).order_by(
+                    'id').values_list('id', 'object_identifier', 'content_hash')
+            )
         except Exception as e:
-            logger.error(f'Unexpected exception gathering object IDs: {e}')
+            logger.error(f'Unexpected exception gathering objects: {e}')
             return Response(
                 _("Problem retrieving related information from database."),
                 status.HTTP_500_INTERNAL_SERVER_ERROR
             )
-        # batch_objects = None
-        # try:
-        #     batch_objects = Batch_Object.objects.filter(object__in=objects)
-        # except Exception as e:
-        #     logger.error(f'Unexpected exception gathering objects: {e}')
-        #     return Response(
-        #         _("Problem retrieving related information from database."),
-        #         status.HTTP_500_INTERNAL_SERVER_ERROR
-        #     )
+        etag = collection_etag((pk, object_content_hash)
+                               for pk, object_identifier, object_content_hash in batch_objects)
+        if etag_matches(request, etag):
+            return apply_cache_headers(request, Response(status=status.HTTP_304_NOT_MODIFIED), etag)
 
         # And end
         batch_object_array = []
-        for batch_object in batch_objects:
-            logger.debug(f'Checking object {batch_object.object_identifier}')
-            try:
+        try:
+            object_data = {}
+            for pk, object_identifier, object_content_hash in batch_objects:
                 batch_object_dict = {}
-                batch_object_dict['object_id'] = batch_object.object_identifier
+                batch_object_dict['object_id'] = object_identifier
                 batch_object_dict['data'] = []
-                batch_object_data_items = None
-                try:
-                    batch_object_data_items = Batch_Object_Data_Item.objects.filter(
-                        object=batch_object)
-                except Batch_Object_Data_Item.DoesNotExist:
-                    logger.warning(
-                        f'Possibly benign: Failed to find data for object with ID {batch_object.id}')
-                for batch_object_data_item in batch_object_data_items:
-                    dict_item = {}
-                    dict_item['key'] = batch_object_data_item.key
-                    dict_item['value'] = batch_object_data_item.value
-                    batch_object_dict['data'].append(dict_item)
+                object_data[pk] = batch_object_dict['data']
                 batch_object_array.append(batch_object_dict)
-            except Exception as e:
-                logger.error(f'Unexpected problem assembling JSON return: {e}')
-                return Response(
-                    _("The server failed while processing the request."),
-                    status.HTTP_500_INTERNAL_SERVER_ERROR
-                )
-        return Response(batch_object_array, status.HTTP_200_OK)
+            batch_object_data_items = Batch_Object_Data_Item.objects.filter(
+                object_id__in=data_objects.values('object_id')).order_by('object_id', 'id')
+            for object_pk, key, value in batch_object_data_items.values_list(
+                    'object_id', 'key', 'value'):
+                if object_pk in object_data:
+                    # Skips any object added since we listed them
+                    object_data[object_pk].append({'key': key, 'value': value})
+        except Exception as e:
+            logger.error(f'Unexpected problem assembling JSON return: {e}')
+            return Response(
+                _("The server failed while processing the request."),
+                status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+        response = apply_cache_headers(
+            request, Response(batch_object_array, status.HTTP_200_OK), etag)
+        if truncated:
+            response['X-Result-Truncated'] = 'true'
+        return response
+
+
+
+class DeleteBatch(APIView):
+    """
+    Deletes a batch, with its objects and their data, by batch ID.  Admin users only.
+    The ORM cascade would load every object and data item first, so this goes through
+    batch_processing.deletion instead.
+
+    A large batch takes a while.  Rather than run into proxy or worker timeouts, we stop after
+    settings.BATCH_DELETE_REQUEST_SECONDS and answer 202 with the rows deleted so far; repeat
+    the request until it answers 200.  Every chunk commits on its own, so a request that is
+    cut off anyway loses nothing, and repeating it resumes the delete in the same way.
+    """
+    permission_classes = [IsAdminUser]
 
+    def delete(self, request, batch_id=None):
+
+        if batch_id is None or batch_id == '':
+            return Response(
+                _("The required batch id was not provided."),
+                status.HTTP_400_BAD_REQUEST
+            )
+        logger.debug(f'Got batch id {batch_id}')
+        batch_pks = list(
+            Batch.objects.filter(batch_identifier__exact=batch_id).values_list('id', flat=True)
+        )
+        if not batch_pks:
+            logger.error(f'Failed to find batch with ID {batch_id}')
+            return Response(
+                _("The request batch was not found in the database."),
+                status.HTTP_404_NOT_FOUND
+            )
+        try:
+            counts = delete_batches(
+                batch_pks, time_limit=getattr(settings, 'BATCH_DELETE_REQUEST_SECONDS', 20))
+            pin_to_primary(request)
+            if not counts['complete']:
+                return Response(counts, status.HTTP_202_ACCEPTED)
+            return Response(counts, status.HTTP_200_OK)
+        except Exception as e:
+            logger.error(f'Unexpected problem deleting batch {batch_id}: {e}')
+            return Response(
+                _("The server failed while processing the request."),
+                status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class RetrieveChanges(ReplicaReadMixin, APIView):
+    """
+    Incremental change feed, so consumers can sync without re-pulling object_list.
+    Returns Object_Change_Log entries after the given cursor, oldest first, one bounded page at a
+    time.  Pass the returned cursor back to get the next page; has_more says whether to ask
+    again straight away.  Created entries carry the object's data.  Objects are never updated
+    in place, so an object that has changed shows up as created under its new batch.
+
+    Consumers must key objects on object_pk.  object_id is not unique: the same object ID can
+    arrive in several batches, and deleting one batch must not remove the copy from another.
+    Every entry carries object_pk and batch_id for that reason.
+
+    An object created and deleted between two polls shows up only as deleted.
+    """
+
+    def get(self, request):
+
+        try:
+            cursor = int(request.GET.get("cursor", 0))
+            limit = int(request.GET.get("limit", getattr(settings, 'CHANGE_FEED_PAGE_SIZE', 500)))
+        except ValueError:
+            return Response(
+                _("cursor and limit must be integers."),
+                status.HTTP_400_BAD_REQUEST
+            )
+        if cursor < 0 or limit < 1:
+            return Response(
+                _("cursor must not be negative and limit must be positive."),
+                status.HTTP_400_BAD_REQUEST
+            )
+        limit = min(limit, getattr(settings, 'CHANGE_FEED_MAX_PAGE_SIZE', 5000))
+        logger.debug(f'Got cursor {cursor} and limit {limit}')
+
+        try:
+            changes = list(
+                Object_Change_Log.objects.filter(id__gt=cursor).order_by('id').values_list(
+                    'id', 'object_pk', 'object_identifier', 'batch_identifier',
+                    'action')[:limit + 1]
+            )
+            has_more = len(changes) > limit
+            changes = changes[:limit]
+
+            # Two queries for the whole page, however many objects it holds
+            created_pks = [change[1] for change in changes
+                           if change[-1] == Object_Change_Log.CREATED]
+            object_data = {
+                pk: [] for pk in Batch_Object.objects.filter(
+                    id__in=created_pks).values_list('id', flat=True)
+            }
+            data_items = Batch_Object_Data_Item.objects.filter(object_id__in=created_pks)
+            for object_pk, key, value in data_items.order_by('id').values_list(
+                    'object_id', 'key', 'value'):
+                object_data[object_pk].append({'key': key, 'value': value})
+
+            change_array = []
+            for sequence, object_pk, object_identifier, batch_identifier, action in changes:
+                change_dict = {
+                    'sequence': sequence,
+                    'object_pk': object_pk,
+                    'object_id': object_identifier,
+                    'batch_id': batch_identifier,
+                }
+                if action == Object_Change_Log.CREATED:
+                    if object_pk not in object_data:
+                        # Deleted since; its deletion comes later in the feed
+                        continue
+                    change_dict['action'] = 'created'
+                    change_dict['data'] = object_data[object_pk]
+                else:
+                    change_dict['action'] = 'deleted'
+                change_array.append(change_dict)
+
+            return Response({
+                'changes': change_array,
+                'cursor': changes[-1][0] if changes else cursor,
+                'has_more': has_more,
+            }, status.HTTP_200_OK)
+        except Exception as e:
+            logger.error(f'Unexpected problem assembling change feed: {e}')
+            return Response(
+                _("The server failed while processing the request."),
+                status.HTTP_500_INTERNAL_SERVER_ERROR
+            )
+
+
+class RetrieveAdmissionStats(APIView):
+    """
+    Upload admission control figures for this worker process, for tuning the ADMISSION_*
+    settings.  Admin users only.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        return Response(admission_controller.stats(), status.HTTP_200_OK)
+
+
+class RetrieveProfileReportList(APIView):
+    """
+    Lists stored profiling reports, newest first.  Admin users only.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        report_array = []
+        for name in list_report_names():
+            report = load_report(name)
+            if report is None:
+                # Pruned while we were listing
+                continue
+            report_array.append({
+                key: report.get(key) for key in (
+                    'name', 'created', 'trigger', 'method', 'path', 'query_string', 'status',
+                    'duration_ms', 'query_count', 'query_time_ms')
+            })
+        return Response(report_array, status.HTTP_200_OK)
+
+
+class RetrieveProfileReport(APIView):
+    """
+    Returns one profiling report, with its profile and SQL statements.  Admin users only.
+    """
+    permission_classes = [IsAdminUser]
+
+    def get(self, request, name=None):
+        report = load_report(name or '')
+        if report is None:
+            return Response(
+                _("The requested profiling report was not found."),
+                status.HTTP_404_NOT_FOUND
+            )
+        return Response(report, status.HTTP_200_OK)